@@ -1,5 +1,8 @@
 import os
 
+# For the deferred task handler, which runs outside of gaemeta.wsgi.
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gaemeta.settings')
+
 on_appengine = os.environ.get('SERVER_SOFTWARE','').startswith('Development')
 if on_appengine and os.name == 'nt':
     os.name = None
@@ -1,27 +1,34 @@
 from meta.admin import site, NdbAdmin, TabularNdbInline
+from meta.prefetch import get_prefetched
 from books.models import Book, Author, Library
 from django.contrib import admin
 
 class BookInline(TabularNdbInline):
   model = Book
+  per_page = 50
 
 class AuthorAdmin(NdbAdmin):
   model = Author
   inlines = [BookInline]
   list_display = ('name', 'sex', 'alive')
   list_filter = ('sex', 'alive')
+  list_filter_counts = True
   # radio_fields = {'sex': admin.HORIZONTAL}
 
 class BookAdmin(NdbAdmin):
   model = Book
   list_display = ('name', 'author', 'get_author', 'pages', 'read')
   list_filter = ('author', 'read')
+  date_hierarchy = 'read'
   radio_fields = {'author': admin.HORIZONTAL}
+  cursor_pagination = True
+  count_strategy = 'bounded'
+  changelist_cache_time = 5 * 60
   #raw_id_fields = ('author',)
   # list_editable = ('pages',)
 
   def get_author(self, obj):
-    return obj.author.get() if obj.author else ""
+    return get_prefetched(obj.author) if obj.author else ""
   get_author.short_description = 'Author'
 
 
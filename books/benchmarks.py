@@ -0,0 +1,175 @@
+import datetime
+
+from django.contrib.admin.helpers import ACTION_CHECKBOX_NAME
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.urlresolvers import reverse
+from django.test import RequestFactory
+from google.appengine.ext import ndb
+
+from books.models import Author, Book, Library
+from meta.admin import NdbAdmin, site
+from meta.benchmarks import scenario
+from meta.models import DjangoCompatibleModel, User
+
+SEED_BATCH_SIZE = 500
+
+
+class Review(DjangoCompatibleModel):
+  """A kind with a large unindexed body, to measure projections against."""
+  title = ndb.StringProperty()
+  rating = ndb.IntegerProperty()
+  body = ndb.TextProperty()
+
+  def __unicode__(self):
+    return self.title
+
+
+def put_batched(entities):
+  """Puts `entities`, which may be a generator, a batch at a time."""
+  keys = []
+  batch = []
+  for entity in entities:
+    batch.append(entity)
+    if len(batch) == SEED_BATCH_SIZE:
+      keys.extend(ndb.put_multi(batch))
+      batch = []
+  keys.extend(ndb.put_multi(batch))
+  return keys
+
+
+def seed(options):
+  """Seeds Authors, Books and Libraries, and returns their keys by kind."""
+  author_keys = put_batched(
+      Author(name='Author %d' % i, sex='Female', alive=bool(i % 2))
+      for i in range(options['authors']))
+  book_keys = put_batched(
+      Book(name='Book %d' % i, author=author_keys[i % len(author_keys)],
+           pages=i % 500,
+           read=datetime.date(2000 + i % 20, i % 12 + 1, i % 28 + 1) if i % 2 else None)
+      for i in range(options['books']))
+  library_keys = put_batched(
+      Library(name='Library %d' % i,
+              books=[book_keys[(i * 10 + j) % len(book_keys)] for j in range(10)])
+      for i in range(options['libraries']))
+  return {'authors': author_keys, 'books': book_keys, 'libraries': library_keys}
+
+
+def admin_request(url, data=None, method='get'):
+  request = getattr(RequestFactory(), method)(url, data or {})
+  request.user = User(username='benchmark', is_staff=True)
+  request._dont_enforce_csrf_checks = True
+  request._messages = CookieStorage(request)
+  return request
+
+
+def admin_url(model, view, *args):
+  opts = model._meta
+  return reverse('%s:%s_%s_%s' % (site.name, opts.app_label, opts.model_name, view),
+                 args=args)
+
+
+def changelist(model, parallel, options, **params):
+  seed(options)
+  model_admin = site._registry[model]
+  request = admin_request(admin_url(model, 'changelist'), params)
+
+  def timed():
+    model_admin.parallel_changelist = parallel
+    try:
+      model_admin.changelist_view(request).render()
+    finally:
+      del model_admin.parallel_changelist
+  return timed
+
+
+@scenario
+def changelist_parallel(options):
+  """Renders the Book changelist with its RPCs run concurrently."""
+  return changelist(Book, True, options)
+
+
+@scenario
+def changelist_sequential(options):
+  """Renders the Book changelist waiting for each RPC in turn."""
+  return changelist(Book, False, options)
+
+
+@scenario
+def changelist_filtered(options):
+  """Renders the Book changelist filtered on an author and sorted by pages."""
+  seeded = seed(options)
+  # Column 4, after the action checkbox, is pages.
+  request = admin_request(admin_url(Book, 'changelist'),
+                          {'author': seeded['authors'][0].urlsafe(), 'o': '-4'})
+  return lambda: site._registry[Book].changelist_view(request).render()
+
+
+@scenario
+def changeform_inlines(options):
+  """Renders the change form of an Author, with a page of its Books inline."""
+  object_id = seed(options)['authors'][0].urlsafe()
+  request = admin_request(admin_url(Author, 'change', object_id))
+  return lambda: site._registry[Author].change_view(request, object_id).render()
+
+
+@scenario
+def key_choices(options):
+  """Renders the author choices of a Book form."""
+  from books.views import BookForm
+  seed(options)
+  return lambda: unicode(BookForm()['author'])
+
+
+def delete_selected(confirmed, options):
+  keys = seed(options)['books'][:options['selected']]
+  data = {'action': 'delete_selected', 'index': 0,
+          ACTION_CHECKBOX_NAME: [key.urlsafe() for key in keys]}
+  if confirmed:
+    data['post'] = 'yes'
+  request = admin_request(admin_url(Book, 'changelist'), data, 'post')
+
+  def timed():
+    response = site._registry[Book].changelist_view(request)
+    if hasattr(response, 'render'):
+      response.render()
+  return timed
+
+
+@scenario
+def delete_selected_confirmation(options):
+  """Renders the confirmation page for deleting the selected Books."""
+  return delete_selected(False, options)
+
+
+@scenario
+def delete_selected_confirmed(options):
+  """Deletes the selected Books."""
+  return delete_selected(True, options)
+
+
+def review_changelist(projection, options):
+  reviews = [Review(title='Review %d' % i, rating=i % 5,
+                    body='x' * options['body_size'])
+             for i in range(options['books'])]
+  ndb.put_multi(reviews)
+  model_admin = NdbAdmin(Review, site)
+  model_admin.list_display = ('title', 'rating')
+  model_admin.list_per_page = 500
+  model_admin.list_projection = projection
+  request = admin_request('/admin/meta/review/')
+
+  def timed():
+    model_admin.changelist_view(request).render()
+  return timed
+
+
+@scenario
+def changelist_projection(options):
+  """Renders a 500 row changelist of large entities fetched as a projection."""
+  return review_changelist(True, options)
+
+
+@scenario
+def changelist_full_entities(options):
+  """Renders the same changelist fetching whole entities."""
+  return review_changelist(False, options)
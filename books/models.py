@@ -6,9 +6,11 @@ class Author(DjangoCompatibleModel):
   name = ndb.StringProperty()
   sex = ndb.StringProperty(choices=('Male', 'Female'))
   alive = ndb.BooleanProperty()
+  updated = ndb.DateTimeProperty(auto_now=True)
 
   class Meta:
     field_order = ['name', 'sex', 'alive']
+    label_fields = ['name']
 
   def __unicode__(self):
     return self.name
@@ -19,9 +21,12 @@ class Book(DjangoCompatibleModel):
   author = ndb.KeyProperty(Author, required=True)
   pages = ndb.IntegerProperty(default=100)
   read = ndb.DateProperty()
+  updated = ndb.DateTimeProperty(auto_now=True)
 
   class Meta:
     field_order = ['name', 'author', 'pages']
+    label_fields = ['name']
+    search_fields = ['name']
 
   def __unicode__(self):
     return self.name
@@ -1,17 +1,111 @@
-from django import forms
+from django.http import HttpResponseBadRequest, StreamingHttpResponse
 from django.shortcuts import render, redirect
-from books.models import Book
+from django.template.loader import render_to_string
+from django.utils.http import urlencode
+from django.utils.safestring import mark_safe
+from django.views.decorators.http import condition
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
 
+from books.models import Author, Book
+from meta import cache
+from meta.forms import NdbModelForm
 
-def books(request):
-  return render(request, 'books.html', {'books': Book.query()})
+# The books rendered and sent at a time.
+BATCH_SIZE = 100
+# The books on a page; the page links to the next one with a cursor.
+PAGE_SIZE = 1000
+CURSOR_VAR = 'cursor'
+
+ROWS_MARKER = mark_safe('<!-- rows -->')
+PAGINATION_MARKER = mark_safe('<!-- pagination -->')
+
+
+@ndb.tasklet
+def get_validators_async():
+  """Returns the (ETag, Last-Modified) of the listing.
+
+  The rows show author names, so both follow the cache generations of Book
+  and Author, which every write bumps; while neither changes they cost three
+  memcache gets and no query.
+  """
+  context = ndb.get_context()
+  generations = yield [cache.get_generation_async(model._get_kind())
+                       for model in (Book, Author)]
+  etag = ':'.join('%s' % generation for generation in generations)
+  cache_key = 'books:last_modified:%s' % etag
+  cached = yield context.memcache_get(cache_key)
+  if cached is None:
+    newest = yield [model.query().order(-model.updated).get_async(projection=[model.updated])
+                    for model in (Book, Author)]
+    updated = [entity.updated for entity in newest if entity is not None]
+    cached = {'last_modified': max(updated) if updated else None}
+    yield context.memcache_set(cache_key, cached)
+  raise ndb.Return((etag, cached['last_modified']))
+
+
+def get_validators(request):
+  if not hasattr(request, 'books_validators'):
+    request.books_validators = get_validators_async().get_result()
+  return request.books_validators
+
+
+def stream_books(request, cursor, batch_size, page_size):
+  """Yields the listing's HTML, a batch of books at a time.
+
+  Each batch is fetched while the previous one is rendered. Neither the
+  books nor their authors go into the context cache, so memory stays flat
+  however long the page is.
+  """
+  page = render_to_string('books.html', {
+      'rows': ROWS_MARKER, 'pagination': PAGINATION_MARKER}, request=request)
+  head, rest = page.split(ROWS_MARKER)
+  middle, tail = rest.split(PAGINATION_MARKER)
+  yield head
+  query = Book.query()
+  rendered = 0
+  next_cursor = None
+  future = query.fetch_page_async(min(batch_size, page_size), start_cursor=cursor,
+                                  use_cache=False)
+  while future is not None:
+    books, cursor, more = future.get_result()
+    rendered += len(books)
+    future = None
+    if more and cursor:
+      if rendered < page_size:
+        future = query.fetch_page_async(min(batch_size, page_size - rendered),
+                                        start_cursor=cursor, use_cache=False)
+      else:
+        next_cursor = cursor
+    author_keys = list(set(book.author for book in books if book.author))
+    authors = dict(zip(author_keys, ndb.get_multi(author_keys, use_cache=False)))
+    yield render_to_string('book_rows.html', {
+        'rows': [(book, authors.get(book.author)) for book in books]}, request=request)
+  yield middle
+  next_url = None
+  if next_cursor is not None:
+    next_url = '%s?%s' % (request.path, urlencode({CURSOR_VAR: next_cursor.urlsafe()}))
+  yield render_to_string('book_pagination.html', {'next_url': next_url}, request=request)
+  yield tail
+
+
+@condition(etag_func=lambda request, **kwargs: get_validators(request)[0],
+           last_modified_func=lambda request, **kwargs: get_validators(request)[1])
+def books(request, batch_size=BATCH_SIZE, page_size=PAGE_SIZE):
+  """Streams the list of books, PAGE_SIZE at a time, in batches of BATCH_SIZE."""
+  cursor = request.GET.get(CURSOR_VAR)
+  try:
+    cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+  except datastore_errors.BadValueError:
+    return HttpResponseBadRequest('Invalid cursor.')
+  return StreamingHttpResponse(stream_books(request, cursor, batch_size, page_size))
 
 def create_book(request, name):
   book = Book(name=name)
   book.put()
   return redirect('/books/')
 
-class BookForm(forms.ModelForm):
+class BookForm(NdbModelForm):
   class Meta:
     model = Book
     fields = '__all__' #('name',  'pages')
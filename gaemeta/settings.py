@@ -41,6 +41,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'meta.middleware.RpcStatsMiddleware',
     'google.appengine.ext.ndb.django_middleware.NdbDjangoMiddleware',
     'meta.middleware.GaeAuthenticationMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -88,6 +89,12 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
+# Show staff users the RPCs each page made; see meta.middleware.RpcStatsMiddleware.
+META_RPC_DEBUG_PANEL = DEBUG
+# Where ?profile saves cProfile stats; None turns profiling off. Only the
+# development server can write files.
+META_PROFILE_DIR = None
+
 
 TEMPLATES = [
     {
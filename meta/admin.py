@@ -1,30 +1,60 @@
+import contextlib
 import datetime
 
 from django.contrib import admin
 from django.contrib import messages
 from django.contrib.admin import helpers, widgets
-from django.contrib.admin.options import BaseModelAdmin, csrf_protect_m, get_ul_class
-from django.contrib.admin.views.main import ChangeList, ORDER_VAR
+from django.contrib.admin.options import BaseModelAdmin, IncorrectLookupParameters, csrf_protect_m, get_ul_class
+from django.contrib.admin.views.main import ChangeList, ERROR_FLAG, ORDER_VAR
 from django.contrib.admin.utils import model_ngettext, quote
-from django.core.exceptions import PermissionDenied
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured, PermissionDenied
+from django.core.paginator import InvalidPage
 from django.core.urlresolvers import NoReverseMatch, reverse
+from django.conf.urls import url
 from django import forms
+from django.http import Http404, HttpResponseRedirect, QueryDict, StreamingHttpResponse
 from django.template.response import TemplateResponse
 from django.utils.html import format_html, escape
 from django.utils.encoding import force_text
 from django.utils.text import capfirst, Truncator
 from django.utils.translation import string_concat, ugettext as _, ugettext_lazy
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb import metadata
 
-from meta.forms import NdbBaseInlineFormSet
+from meta.forms import NdbBaseInlineFormSet, NdbBaseModelFormSet, NdbModelForm, get_key_choices_async
+from meta import batch
+from meta import cache
+from meta import counters
+from meta import export
+from meta import importer
 from meta import models
+from meta import search
+from meta import tasks
+from meta import views
+from meta.prefetch import get_prefetched, get_prefetched_multi, prefetch
+
+# Query string parameters used by cursor-based pagination.
+CURSOR_VAR = 'cursor'
+DIRECTION_VAR = 'dir'
+
+# Exports everything the changelist matches, in the format it names.
+EXPORT_VAR = '_export'
+
+# The number of import errors listed in the message after an upload.
+IMPORT_ERRORS_SHOWN = 5
+
+# List filters with more choices than this are shown without counts.
+MAX_FACET_CHOICES = 50
+
+# The number of entities listed on the delete confirmation page.
+DELETE_CONFIRMATION_SAMPLE = 100
+KEY_PLACEHOLDER = '__key__'
 
 
 class KeyRawIdWidget(widgets.ForeignKeyRawIdWidget):
   def label_for_value(self, value):
-    key = ndb.Key(urlsafe=value)
-    obj = key.get()
+    obj = get_prefetched(ndb.Key(urlsafe=value))
     if obj:
       return '&nbsp;<strong>%s</strong>' % escape(Truncator(obj).words(14, truncate='...'))
     else:
@@ -32,15 +62,57 @@ class KeyRawIdWidget(widgets.ForeignKeyRawIdWidget):
 
 
 class MultipleKeyRawIdWidget(widgets.ManyToManyRawIdWidget, forms.Textarea, forms.TextInput):
-  #def render(self, *args, **kwargs):
-    #import pdb; pdb.set_trace()
-    #super(MultipleKeyRawIdWidget, self).render(*args, **kwargs)
-
   def label_for_value(self, value):
-    return ''
+    keys = [ndb.Key(urlsafe=v) for v in value.split(',') if v]
+    labels = [force_text(obj) for obj in get_prefetched_multi(keys) if obj]
+    if labels:
+      return '&nbsp;<strong>%s</strong>' % escape(Truncator(', '.join(labels)).words(14, truncate='...'))
+    else:
+      return ''
+
+
+def prefetch_raw_id_labels(forms_):
+  """Starts one batch get for the labels of every raw id widget in `forms_`."""
+  keys = []
+  for form in forms_:
+    for name, field in form.fields.items():
+      widget = getattr(field.widget, 'widget', field.widget)
+      if not isinstance(widget, (KeyRawIdWidget, MultipleKeyRawIdWidget)):
+        continue
+      value = form[name].value()
+      if not value:
+        continue
+      if isinstance(widget, KeyRawIdWidget):
+        value = [value]
+      keys.extend(v if isinstance(v, ndb.Key) else ndb.Key(urlsafe=v)
+                  for v in value if v)
+  prefetch(keys)
 
 class BaseNdbAdmin(BaseModelAdmin):
   actions_selection_counter = False
+  # Page the changelist with datastore cursors rather than offsets, so deep
+  # pages cost the same as the first one.
+  cursor_pagination = False
+  # KeyProperty names, besides those in list_display, whose entities should be
+  # batch fetched for the changelist; for use by list_display callables.
+  list_prefetch_keys = ()
+  # How the changelist counts results; see meta.counters.
+  count_strategy = 'exact'
+  count_limit = 1000
+  # Run the changelist's datastore calls concurrently rather than one by one.
+  parallel_changelist = True
+  # Fetch the changelist as a projection on list_display where possible.
+  list_projection = True
+  # Seconds for which the changelist's page keys and counts are cached in
+  # memcache, or None not to cache them. Any write of the kind through
+  # DjangoCompatibleModel drops them at once; see NdbChangeList.get_cached_async.
+  changelist_cache_time = None
+  # Show how many entities each choice of the list filters would leave; the
+  # counts stop at facet_count_limit, and are cached for facet_cache_time.
+  list_filter_counts = False
+  facet_count_limit = 100
+  facet_cache_time = 60
+  form = NdbModelForm
   formfield_overrides = {
       models.DateTimePropertyWrapper: {
           'form_class': forms.SplitDateTimeField,
@@ -49,6 +121,8 @@ class BaseNdbAdmin(BaseModelAdmin):
       models.DatePropertyWrapper: {'widget': widgets.AdminDateWidget},
       models.TimePropertyWrapper: {'widget': widgets.AdminTimeWidget},
       models.TextPropertyWrapper: {'widget': widgets.AdminTextareaWidget},
+      models.JsonPropertyWrapper: {'widget': widgets.AdminTextareaWidget},
+      models.StructuredPropertyWrapper: {'widget': widgets.AdminTextareaWidget},
       models.IntegerPropertyWrapper: {'widget': widgets.AdminIntegerFieldWidget},
       models.StringPropertyWrapper: {'widget': widgets.AdminTextInputWidget},
   }
@@ -82,11 +156,70 @@ class BaseNdbAdmin(BaseModelAdmin):
     return qs
   def get_changelist(self, request, **kwargs):
     return NdbChangeList
+  def get_search_fields(self, request):
+    return self.search_fields or self.model._meta.search_fields or ()
+  def get_search_results(self, request, queryset, search_term):
+    """Filters `queryset` to the entities with words starting with each term.
+
+    The words come from the model's search index, so every search field must
+    be listed in its Meta.search_fields.
+    """
+    search_fields = self.get_search_fields(request)
+    if not search_term or not search_fields:
+      return queryset, False
+    missing = (set(search.search_field_names(search_fields)) -
+               set(self.model._meta.search_fields or ()))
+    if missing:
+      raise ImproperlyConfigured(
+          "%s searches %s, which %s.Meta.search_fields does not index." %
+          (type(self).__name__, ', '.join(sorted(missing)), self.model.__name__))
+    return search.filter_query(queryset, self.model, search_term), False
   def get_pk_value_for_object(self, obj):
     return obj.key.urlsafe()
+  @contextlib.contextmanager
+  def batch_writes(self, request):
+    """Collects the writes of the admin's save paths and sends them together.
+
+    The batch is written when the enclosed view returns successfully, before
+    its response goes out; if the view fails, nothing is written.
+    """
+    request.write_batch = batch.WriteBatch()
+    yield
+    request.write_batch.flush()
+  def get_write_batch(self, request):
+    return getattr(request, 'write_batch', None)
   @csrf_protect_m
-  def changeform_view(self, *args, **kwargs):
-    return self._changeform_view(*args, **kwargs)
+  def changeform_view(self, request, *args, **kwargs):
+    with self.batch_writes(request):
+      return self._changeform_view(request, *args, **kwargs)
+  def save_model(self, request, obj, form, change):
+    write_batch = self.get_write_batch(request)
+    if write_batch is None:
+      return obj.save()
+    if obj.key is None:
+      # Inlines and the response need the key before the batch is written.
+      start, end = obj.allocate_ids(1)
+      obj.key = ndb.Key(obj._get_kind(), start)
+    write_batch.put(obj)
+  def delete_model(self, request, obj):
+    write_batch = self.get_write_batch(request)
+    if write_batch is None:
+      return obj.delete()
+    write_batch.delete(obj.key)
+  def save_formset(self, request, form, formset, change):
+    write_batch = self.get_write_batch(request)
+    if write_batch is None:
+      return formset.save()
+    write_batch.put_multi(formset.save(commit=False))
+    write_batch.delete_multi([obj.key for obj in formset.deleted_objects])
+  def render_change_form(self, request, context, *args, **kwargs):
+    # The response renders lazily, so the labels for the raw id widgets of the
+    # form and all its inlines can be fetched together first.
+    forms_ = [context['adminform'].form]
+    for inline_admin_formset in context.get('inline_admin_formsets', []):
+      forms_.extend(inline_admin_formset.formset.forms)
+    prefetch_raw_id_labels(forms_)
+    return super(BaseNdbAdmin, self).render_change_form(request, context, *args, **kwargs)
   def get_deleted_objects(self, obj, user):
     return [obj], {obj._meta.verbose_name_plural: 1}, [], False
   def get_content_type(self):
@@ -154,41 +287,191 @@ class KwargFieldListFilter(admin.filters.FieldListFilter):
     return queryset
 
 
-class NdbChoiceFieldFilter(admin.filters.ChoicesFieldListFilter, KwargFieldListFilter):
-  pass
+class FacetCountsMixin(object):
+  """Shows the number of entities each choice of a list filter would leave.
+
+  With the admin's list_filter_counts, NdbChangeList calls start_facet_counts
+  with the changelist's query minus this filter, so that the bounded counts
+  of every choice of every filter are in flight at once. choices() waits for
+  them as the sidebar renders. Filters with more than MAX_FACET_CHOICES
+  choices are not counted.
+  """
+  facet_total = None
+  facet_counts = None
+
+  def facet_values(self):
+    """Returns the lookup values of the choices after "All", None for the empty one."""
+    return []
+
+  def start_facet_counts(self, cl, queryset):
+    values = self.facet_values()
+    if len(values) > MAX_FACET_CHOICES:
+      return
+    prop = self.model._properties[self.field_path]
+    self.facet_total = cl.count_facet_async(queryset)
+    # By lookup value, as the choices need not come in the order of the values:
+    # the empty one is always last.
+    self.facet_counts = {}
+    for value in values:
+      if value is not None:
+        value = force_text(value)
+        query = queryset.filter(prop == self.convert_value(value))
+      else:
+        query = queryset.filter(prop == None)
+      self.facet_counts[value] = cl.count_facet_async(query)
+
+  def choice_count(self, choice):
+    """Returns the future count of `choice`, from the lookup its query string makes."""
+    params = QueryDict(choice['query_string'].lstrip('?'))
+    if self.lookup_kwarg in params:
+      return self.facet_counts.get(params[self.lookup_kwarg])
+    if params.get(self.lookup_kwarg_isnull):
+      return self.facet_counts.get(None)
+    return self.facet_total
+
+  def choices(self, cl):
+    for choice in super(FacetCountsMixin, self).choices(cl):
+      count = self.choice_count(choice) if self.facet_counts is not None else None
+      if count is not None:
+        choice = dict(choice, display=format_html(
+            '{} ({})', choice['display'], count.get_result()))
+      yield choice
+
+
+class NdbChoiceFieldFilter(FacetCountsMixin, admin.filters.ChoicesFieldListFilter, KwargFieldListFilter):
+  def facet_values(self):
+    return [lookup for lookup, title in self.field.flatchoices]
 admin.filters.FieldListFilter.register(lambda f: bool(f.choices), NdbChoiceFieldFilter, True)
 
 
-class NdbRelatedFieldListFilter(admin.filters.RelatedFieldListFilter, KwargFieldListFilter):
+class FutureList(object):
+  """A sequence that only waits for the future producing it when it is used."""
+  def __init__(self, future):
+    self.future = future
+
+  def __iter__(self):
+    return iter(self.future.get_result())
+
+  def __len__(self):
+    return len(self.future.get_result())
+
+
+class NdbRelatedFieldListFilter(FacetCountsMixin, admin.filters.RelatedFieldListFilter, KwargFieldListFilter):
   def convert_value(self, val):
     return ndb.Key(urlsafe=val)
+
+  def facet_values(self):
+    values = [pk for pk, label in self.lookup_choices]
+    return values + [None] if self.include_empty_choice else values
+
+  def field_choices(self, field, request, model_admin):
+    # Loaded while the changelist fetches its page, and only waited for when
+    # the sidebar renders.
+    choices = FutureList(get_key_choices_async(ndb.Query(kind=field.property._kind)))
+    if not model_admin.parallel_changelist:
+      len(choices)
+    return choices
+
+  def has_output(self):
+    # Counting the choices would mean waiting for them.
+    return True
 admin.filters.FieldListFilter.register(lambda f: f.remote_field, NdbRelatedFieldListFilter, True)
 
-class BooleanFieldListFilter(admin.filters.BooleanFieldListFilter, KwargFieldListFilter):
+class BooleanFieldListFilter(FacetCountsMixin, admin.filters.BooleanFieldListFilter, KwargFieldListFilter):
+  @property
+  def lookup_kwarg_isnull(self):
+    return self.lookup_kwarg2
+
   def convert_value(self, val):
     return bool(int(val))
+
+  def facet_values(self):
+    return ['1', '0']
 admin.filters.FieldListFilter.register(lambda f: isinstance(f.property, ndb.BooleanProperty), BooleanFieldListFilter, True)
 
+def filter_date_range(queryset, prop, since=None, until=None):
+  """Filters `queryset` to values of the date or datetime `prop` in [since, until).
+
+  `since` and `until` are dates, or None for an open end.
+  """
+  if not isinstance(prop, ndb.DateProperty):
+    since = since and datetime.datetime.combine(since, datetime.time())
+    until = until and datetime.datetime.combine(until, datetime.time())
+  if since is not None:
+    queryset = queryset.filter(prop >= since)
+  if until is not None:
+    queryset = queryset.filter(prop < until)
+  return queryset
+
+
+def next_period(date, period):
+  """Returns the start of the year, month or day after the one `date` starts."""
+  if period == 'year':
+    return datetime.date(date.year + 1, 1, 1)
+  if period == 'month':
+    return datetime.date(date.year + date.month // 12, date.month % 12 + 1, 1)
+  return date + datetime.timedelta(days=1)
+
+
 class DateFieldListFilter(admin.filters.DateFieldListFilter, KwargFieldListFilter):
   def queryset(self, request, queryset):
-    for field, val in self.used_parameters.items():
-      val = self.convert_value(val)
-      if field == self.lookup_kwarg_since:
-        queryset = queryset.filter(self.model._properties[self.field_path]>=val)
-      elif field == self.lookup_kwarg_until:
-        queryset = queryset.filter(self.model._properties[self.field_path]<val)
-    return queryset
+    since = self.used_parameters.get(self.lookup_kwarg_since)
+    until = self.used_parameters.get(self.lookup_kwarg_until)
+    return filter_date_range(
+        queryset, self.model._properties[self.field_path],
+        since and self.convert_value(since), until and self.convert_value(until))
 
   def convert_value(self, val):
     return datetime.datetime.strptime(val, '%Y-%m-%d').date()
-admin.filters.FieldListFilter.register(lambda f: isinstance(f.property, ndb.DateProperty), DateFieldListFilter, True)
+# TimeProperty subclasses DateTimeProperty, but has no dates to filter on.
+admin.filters.FieldListFilter.register(
+    lambda f: (isinstance(f.property, ndb.DateTimeProperty) and
+               not isinstance(f.property, ndb.TimeProperty)),
+    DateFieldListFilter, True)
+
+
+def project_columns(opts, list_display, equality_filtered=()):
+  """Returns the properties to project the `list_display` columns onto, or None.
+
+  Callables, unindexed or repeated properties, and properties with an equality
+  filter (which the datastore won't project) all need whole entities.
+  """
+  projection = []
+  for name in list_display:
+    if name == 'action_checkbox':
+      continue
+    try:
+      field = opts.get_field(name)
+    except FieldDoesNotExist:
+      return None
+    if isinstance(field, models.KeyWrapper):
+      continue
+    prop = field.property
+    if (not prop._indexed or prop._repeated or name in equality_filtered or
+        isinstance(prop, (ndb.StructuredProperty, ndb.LocalStructuredProperty))):
+      return None
+    projection.append(prop)
+  return projection or None
 
 
 class NdbChangeList(ChangeList):
-  def get_ordering(self, request, queryset):
+  # Whether the changelist fetches its page and counts; an export only needs
+  # the filtered query.
+  fetch_results = True
+
+  def get_ordering_fields(self, request):
+    """Returns the requested ordering as a list of (property, descending) pairs."""
     params = self.params
-    ordering = list(self.model_admin.get_ordering(request)
-                    or self._get_default_ordering())
+    ordering = []
+    for order_field in (self.model_admin.get_ordering(request)
+                        or self._get_default_ordering()):
+      try:
+        if order_field.startswith('-'):
+          ordering.append((self.model._properties[order_field[1:]], True))
+        else:
+          ordering.append((self.model._properties[order_field], False))
+      except KeyError:
+        continue
     if ORDER_VAR in params:
       # Clear ordering and used params
       ordering = []
@@ -202,82 +485,651 @@ class NdbChangeList(ChangeList):
             continue  # No 'admin_order_field', skip it
           # reverse order if order_field has already "-" as prefix
           if order_field.startswith('-') and pfx == "-":
-            ordering.append(self.model._properties[order_field[1:]])
+            ordering.append((self.model._properties[order_field[1:]], False))
+          elif order_field.startswith('-'):
+            ordering.append((self.model._properties[order_field[1:]], True))
           else:
             field = self.model._properties[order_field]
-            if pfx == '-':
-              ordering.append(-field)
-            else:
-              ordering.append(field)
+            ordering.append((field, pfx == '-'))
         except (IndexError, ValueError, KeyError):
           continue  # Invalid ordering specified, skip it.
+    range_property = self.get_range_property()
+    if range_property is not None and ordering[:1] != [(range_property, False)]:
+      # The datastore only takes a range filter on the property it sorts on
+      # first; the requested ordering still applies within it.
+      ordering = [(range_property, False)] + [
+          (prop, descending) for prop, descending in ordering
+          if prop is not range_property]
+    if self.cursor_pagination:
+      # Cursors are only stable, and only reversible, if the ordering is total.
+      ordering.append((self.model.key, False))
+    return ordering
 
-    queryset = queryset.order(*ordering)
+  def get_range_property(self):
+    """Returns the property the query filters on with a range, or None."""
+    for spec in self.filter_specs:
+      if isinstance(spec, DateFieldListFilter) and spec.used_parameters:
+        return self.model._properties[spec.field_path]
+    if self.date_hierarchy and self.date_lookups[0]:
+      return self.model._properties[self.date_hierarchy]
+    return None
+
+  def get_orders(self, reverse=False):
+    return [-field if descending != reverse else field
+            for field, descending in self.ordering]
+
+  def get_ordering(self, request, queryset):
+    self.ordering = self.get_ordering_fields(request)
+    queryset = queryset.order(*self.get_orders())
     return queryset
 
   def get_queryset(self, request):
+    # A cursor identifies a position in one particular query, so it must not
+    # leak into the filter and ordering links.
+    for param in (CURSOR_VAR, DIRECTION_VAR):
+      self.params.pop(param, None)
     # First, we collect all the declared list filters.
     (self.filter_specs, self.has_filters, remaining_lookup_params,
       filters_use_distinct) = self.get_filters(request)
-    queryset = self.root_queryset
+    queryset = self.filter_queryset(request, self.root_queryset)
+    if self.date_hierarchy:
+      self.date_lookups = self.get_date_lookups()
+      self.date_hierarchy_queryset = queryset
+      queryset = self.filter_date_hierarchy(queryset)
+      if self.fetch_results:
+        self.date_hierarchy_future = self.get_date_hierarchy_async()
+        if not self.model_admin.parallel_changelist:
+          self.date_hierarchy_future.wait()
+    # Each filter's choices are counted among the results of the others.
+    self.facet_querysets = []
+    if self.model_admin.list_filter_counts:
+      for filter_spec in self.filter_specs:
+        if isinstance(filter_spec, FacetCountsMixin):
+          facet_queryset = self.filter_queryset(request, self.root_queryset, filter_spec)
+          if self.date_hierarchy:
+            facet_queryset = self.filter_date_hierarchy(facet_queryset)
+          self.facet_querysets.append((filter_spec, facet_queryset))
+    unordered_queryset = queryset
     queryset = self.get_ordering(request, queryset)
-    for filter_spec in self.filter_specs:
-        new_queryset = filter_spec.queryset(request, queryset)
-        if new_queryset is not None:
-            queryset = new_queryset
+    # Used to page backwards from a cursor.
+    self.reversed_queryset = unordered_queryset.order(*self.get_orders(reverse=True))
     # order/filter return a new query so we need to re-annotate the fake _clone method.
     queryset._clone = lambda: queryset
+    self.projection = self.get_projection()
     return queryset
 
+  def filter_queryset(self, request, queryset, exclude=None):
+    """Applies the list filters, except `exclude`, and the search to `queryset`."""
+    for filter_spec in self.filter_specs:
+      if filter_spec is exclude:
+        continue
+      new_queryset = filter_spec.queryset(request, queryset)
+      if new_queryset is not None:
+        queryset = new_queryset
+    queryset, use_distinct = self.model_admin.get_search_results(
+        request, queryset, self.query)
+    return queryset
+
+  def get_date_lookups(self):
+    """Returns the (year, month, day) the date hierarchy has drilled down to.
+
+    The ones not chosen yet are None.
+    """
+    lookups = []
+    for part in ('year', 'month', 'day'):
+      value = self.params.get('%s__%s' % (self.date_hierarchy, part))
+      if not value or (lookups and lookups[-1] is None):
+        lookups.append(None)
+        continue
+      try:
+        lookups.append(int(value))
+      except ValueError:
+        raise IncorrectLookupParameters
+    year, month, day = lookups
+    try:
+      datetime.date(year or 1, month or 1, day or 1)
+    except ValueError:
+      raise IncorrectLookupParameters
+    return year, month, day
+
+  def filter_date_hierarchy(self, queryset):
+    year, month, day = self.date_lookups
+    if not year:
+      return queryset
+    since = datetime.date(year, month or 1, day or 1)
+    until = next_period(since, 'day' if day else 'month' if month else 'year')
+    return filter_date_range(
+        queryset, self.model._properties[self.date_hierarchy], since, until)
+
+  @ndb.tasklet
+  def get_date_hierarchy_async(self):
+    """Finds the dates the date hierarchy offers to drill down to.
+
+    Returns a tuple of (year, month, day, dates): the year, month and day
+    drilled down to, which with no choice made are those all the entities
+    share, and the first days of the years, months or days at the next level
+    which have entities. The range of years comes from the first and last
+    values, which are two single entity projections.
+    """
+    prop = self.model._properties[self.date_hierarchy]
+    query = self.date_hierarchy_queryset
+    year, month, day = self.date_lookups
+    if not year:
+      # Entities without a value come first in ascending order.
+      first, last = yield (query.filter(prop > None).order(prop).get_async(projection=[prop]),
+                           query.order(-prop).get_async(projection=[prop]))
+      if first is None or last is None:
+        raise ndb.Return((None, None, None, []))
+      first, last = getattr(first, prop._code_name), getattr(last, prop._code_name)
+      if first.year != last.year:
+        dates = yield self.get_dates_async(
+            query, prop, 'year', datetime.date(first.year, 1, 1),
+            datetime.date(last.year + 1, 1, 1))
+        raise ndb.Return((None, None, None, dates))
+      year = first.year
+      if first.month == last.month:
+        month = first.month
+    if day:
+      raise ndb.Return((year, month, day, []))
+    if month:
+      since = datetime.date(year, month, 1)
+      dates = yield self.get_dates_async(
+          query, prop, 'day', since, next_period(since, 'month'))
+    else:
+      dates = yield self.get_dates_async(
+          query, prop, 'month', datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1))
+    raise ndb.Return((year, month, day, dates))
+
+  @ndb.tasklet
+  def get_dates_async(self, query, prop, period, since, until):
+    """Returns the start of each year, month or day in [since, until) with entities.
+
+    The days of a DateProperty come from a single distinct projection, which
+    returns at most one row per day. Otherwise each period is probed with a
+    keys-only query for one entity; the probes all run at once.
+    """
+    if period == 'day' and isinstance(prop, ndb.DateProperty):
+      query = filter_date_range(query, prop, since, until)
+      # ndb takes distinct as the projection grouped by its properties, which
+      # only the constructor accepts.
+      query = ndb.Query(kind=query.kind, ancestor=query.ancestor, filters=query.filters,
+                        orders=query.orders, namespace=query.namespace,
+                        projection=[prop], group_by=[prop])
+      results = yield query.fetch_async()
+      raise ndb.Return(sorted(set(getattr(r, prop._code_name) for r in results)))
+    starts = []
+    while since < until:
+      starts.append(since)
+      since = next_period(since, period)
+    found = yield [
+        filter_date_range(query, prop, start, next_period(start, period)).get_async(keys_only=True)
+        for start in starts]
+    raise ndb.Return([start for start, key in zip(starts, found) if key is not None])
+
+  def get_projection(self):
+    """Returns the properties to project the page onto, or None.
+
+    When every column is a plain indexed property, the page is fetched as a
+    projection, which reads only those values from the index instead of
+    fetching and decoding whole entities. list_editable saves the rows, so it
+    needs whole entities; see project_columns() for the columns that do too.
+    Note that a projection omits entities that have no value for one of its
+    properties, such as those written before the property was added. Cached
+    pages hold keys, so with changelist_cache_time they are not projected.
+    """
+    model_admin = self.model_admin
+    if (not model_admin.list_projection or self.list_editable or
+        model_admin.changelist_cache_time):
+      return None
+    equality_filtered = set(
+        spec.field_path for spec in self.filter_specs
+        if spec.used_parameters and not isinstance(spec, DateFieldListFilter))
+    return project_columns(self.lookup_opts, self.list_display, equality_filtered)
+
+  @property
+  def cursor_pagination(self):
+    return self.model_admin.cursor_pagination
+
+  @ndb.tasklet
+  def get_cached_async(self, name, query, parts, compute_async, time=None):
+    """Returns the result of compute_async() for `query`, cached in memcache.
+
+    The cache key is a fingerprint of the query's kind, filters and orders
+    and of `parts`, such as the page's offset or cursor, under the generation
+    of the kind, which every write of it bumps.
+    """
+    context = ndb.get_context()
+    cache_key = yield cache.make_key_async(
+        'changelist', query.kind, name, cache.query_fingerprint(query), parts)
+    cached = yield context.memcache_get(cache_key)
+    cache.count_lookup('changelist', cached is not None)
+    if cached is not None:
+      raise ndb.Return(cached['value'])
+    value = yield compute_async()
+    if time is None:
+      time = self.model_admin.changelist_cache_time
+    yield context.memcache_set(cache_key, {'value': value}, time)
+    raise ndb.Return(value)
+
+  @ndb.tasklet
+  def fetch_async(self, limit, offset=0):
+    """Returns `limit` results from `offset`.
+
+    Cached pages are lists of keys, whose entities come from ndb's cache.
+    """
+    if not self.model_admin.changelist_cache_time:
+      results = yield self.queryset.fetch_async(limit, offset=offset,
+                                                projection=self.projection)
+      raise ndb.Return(results)
+    keys = yield self.get_cached_async(
+        'page', self.queryset, (limit, offset),
+        lambda: self.queryset.fetch_async(limit, offset=offset, keys_only=True))
+    results = yield ndb.get_multi_async(keys)
+    raise ndb.Return([obj for obj in results if obj is not None])
+
+  @ndb.tasklet
+  def fetch_page_async(self, query, cursor):
+    """Returns (results, next cursor, more) for a page of `query` from `cursor`."""
+    if not self.model_admin.changelist_cache_time:
+      page = yield query.fetch_page_async(
+          self.list_per_page, start_cursor=cursor, projection=self.projection)
+      raise ndb.Return(page)
+
+    @ndb.tasklet
+    def fetch_keys_async():
+      keys, next_cursor, more = yield query.fetch_page_async(
+          self.list_per_page, start_cursor=cursor, keys_only=True)
+      raise ndb.Return((keys, next_cursor and next_cursor.urlsafe(), more))
+
+    keys, next_cursor, more = yield self.get_cached_async(
+        'page', query, (self.list_per_page, cursor and cursor.urlsafe()),
+        fetch_keys_async)
+    results = yield ndb.get_multi_async(keys)
+    raise ndb.Return(([obj for obj in results if obj is not None],
+                      next_cursor and ndb.Cursor(urlsafe=next_cursor), more))
+
+  def count_async(self, query, filtered=True):
+    model_admin = self.model_admin
+    count_async = lambda: counters.count_async(
+        query, model_admin.count_strategy, model_admin.count_limit, filtered=filtered)
+    if not model_admin.changelist_cache_time:
+      return count_async()
+    return self.get_cached_async(
+        'count', query, (model_admin.count_strategy, model_admin.count_limit, filtered),
+        count_async)
+
+  def count_facet_async(self, query):
+    """Returns a bounded count of `query` for a list filter choice."""
+    model_admin = self.model_admin
+    return self.get_cached_async(
+        'facet', query, (model_admin.facet_count_limit,),
+        lambda: counters.bounded_count_async(query, model_admin.facet_count_limit),
+        model_admin.facet_cache_time)
+
+  def start_facet_counts(self):
+    for filter_spec, queryset in self.facet_querysets:
+      filter_spec.start_facet_counts(self, queryset)
+
+  @ndb.tasklet
+  def get_counts_async(self):
+    """Returns (result_count, full_result_count) using the admin's strategy."""
+    model_admin = self.model_admin
+    # The search term is not among the filter parameters, but filters too.
+    filtered = bool(self.get_filters_params() or (self.query and self.search_fields))
+    full_result_count = result_count = None
+    if model_admin.show_full_result_count or not filtered:
+      full_result_count = self.count_async(self.root_queryset, filtered=False)
+      if not model_admin.parallel_changelist:
+        yield full_result_count
+    if filtered:
+      result_count = self.count_async(self.queryset)
+    if full_result_count is not None:
+      full_result_count = yield full_result_count
+    if result_count is not None:
+      result_count = yield result_count
+    else:
+      result_count = full_result_count
+    raise ndb.Return((result_count, full_result_count))
+
+  def get_results(self, request):
+    if self.fetch_results:
+      self.get_results_async(request).get_result()
+
+  @ndb.tasklet
+  def get_results_async(self, request):
+    """Fetches the page and its counts concurrently.
+
+    The counts, the page, the filter sidebar choices (which the filters
+    started already) and their counts are all in flight together, so the
+    changelist waits about as long as the slowest of them rather than for
+    their sum. The admin's parallel_changelist option turns this off, for
+    comparison.
+    """
+    counts = self.get_counts_async()
+    if not self.model_admin.parallel_changelist:
+      yield counts
+    if self.cursor_pagination:
+      page = self.get_page_async(request)
+    elif self.show_all:
+      page = self.fetch_async(self.list_max_show_all)
+    else:
+      page = self.fetch_async(self.list_per_page, self.page_num * self.list_per_page)
+    # Started once the counts and the page are in flight, as a related
+    # filter must wait for its choices before counting them.
+    self.start_facet_counts()
+    (result_count, full_result_count), page = yield counts, page
+
+    if self.cursor_pagination:
+      self.result_list, self.previous_cursor, self.next_cursor = page
+      self.can_show_all = False
+      self.show_all = False
+      self.multi_page = bool(self.previous_cursor or self.next_cursor)
+      self.paginator = None
+    else:
+      paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+      # Don't let the paginator count the query again.
+      paginator.count = result_count
+      self.can_show_all = result_count <= self.list_max_show_all
+      self.multi_page = result_count > self.list_per_page
+      if not (self.show_all and self.can_show_all):
+        try:
+          paginator.validate_number(self.page_num + 1)
+        except InvalidPage:
+          raise IncorrectLookupParameters
+        if self.show_all:
+          # There were too many to show all of them after all.
+          page = yield self.fetch_async(
+              self.list_per_page, self.page_num * self.list_per_page)
+      self.result_list = page
+      self.paginator = paginator
+
+    self.result_count = result_count
+    self.show_full_result_count = self.model_admin.show_full_result_count
+    # Admin actions are shown if there is at least one entry
+    # or if entries are not counted because show_full_result_count is disabled
+    self.show_admin_actions = not self.show_full_result_count or bool(full_result_count)
+    if not self.show_full_result_count:
+      full_result_count = None
+    self.full_result_count = full_result_count
+    self.prefetch_related(self.result_list)
+
+  @ndb.tasklet
+  def get_page_async(self, request):
+    """Fetches one page of results starting from the cursor in the request.
+
+    Returns a tuple of (results, previous_cursor, next_cursor); either cursor is
+    None if there is no page in that direction. Each page is a single
+    fetch_page call whatever its depth, as the datastore resumes from the cursor
+    rather than skipping over an offset.
+    """
+    try:
+      cursor = request.GET.get(CURSOR_VAR)
+      cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    except datastore_errors.BadValueError:
+      raise IncorrectLookupParameters
+    if cursor and request.GET.get(DIRECTION_VAR) == 'prev':
+      results, start_cursor, more = yield self.fetch_page_async(
+          self.reversed_queryset, cursor.reversed())
+      results.reverse()
+      previous_cursor = start_cursor.reversed() if more and start_cursor else None
+      raise ndb.Return((results, previous_cursor, cursor))
+    results, next_cursor, more = yield self.fetch_page_async(self.queryset, cursor)
+    raise ndb.Return((results, cursor, next_cursor if more else None))
+
+  def get_prefetch_fields(self):
+    """Returns the KeyProperty wrappers whose values are shown on the page."""
+    names = list(self.list_display) + list(self.model_admin.list_prefetch_keys)
+    fields = []
+    for name in names:
+      try:
+        field = self.lookup_opts.get_field(name)
+      except FieldDoesNotExist:
+        continue
+      if isinstance(field, models.KeyPropertyWrapper):
+        fields.append(field)
+    return fields
+
+  def prefetch_related(self, results):
+    """Starts a single batch get for every key referenced on this page.
+
+    Rendering reads the entities back through get_prefetched, so the
+    page costs one RPC however many rows and key columns it has.
+    """
+    keys = []
+    for field in self.get_prefetch_fields():
+      for obj in results:
+        value = getattr(obj, field.name)
+        if field.property._repeated:
+          keys.extend(value or [])
+        elif value:
+          keys.append(value)
+    prefetch(keys)
+
 
 class NdbAdmin(BaseNdbAdmin, admin.ModelAdmin):
-    pass
+    change_list_template = 'admin/ndb_change_list.html'
+
+    def get_list_display(self, request):
+      """Shows compressed and serialized properties by their summary.
+
+      Displaying the value itself would decode it for every row.
+      """
+      return [self.get_summary_column(name)
+              for name in super(NdbAdmin, self).get_list_display(request)]
+
+    def get_summary_column(self, name):
+      """Returns a column showing the summary of the `name` property, if it has one."""
+      if not isinstance(name, basestring):
+        return name
+      try:
+        field = self.opts.get_field(name)
+      except FieldDoesNotExist:
+        return name
+      if not isinstance(field, models.LargePropertyWrapper):
+        return name
+      columns = self.__dict__.setdefault('_summary_columns', {})
+      if name not in columns:
+        column = lambda obj: field.summary(obj)
+        column.short_description = capfirst(field.verbose_name)
+        columns[name] = column
+      return columns[name]
+
+    @csrf_protect_m
+    def changelist_view(self, request, *args, **kwargs):
+      if EXPORT_VAR in request.GET:
+        return self.export_view(request)
+      # Rows saved through list_editable are written in one batch.
+      with self.batch_writes(request):
+        return super(NdbAdmin, self).changelist_view(request, *args, **kwargs)
+
+    def get_changelist_formset(self, request, **kwargs):
+      # Takes the page of results as a list, and fetches only the submitted rows.
+      kwargs.setdefault('formset', NdbBaseModelFormSet)
+      return super(NdbAdmin, self).get_changelist_formset(request, **kwargs)
+
+    def export_view(self, request):
+      """Exports everything the changelist matches, in its order."""
+      fmt = request.GET[EXPORT_VAR]
+      if fmt not in export.FORMATS:
+        raise Http404
+      request.GET = request.GET.copy()
+      del request.GET[EXPORT_VAR]
+      list_display = self.get_list_display(request)
+      if self.get_actions(request):
+        # The ordering parameter counts the action checkbox column.
+        list_display = ['action_checkbox'] + list(list_display)
+      changelist = self.get_changelist(request)
+      # Only the query is needed; export_response counts it.
+      changelist = type(changelist.__name__, (changelist,), {'fetch_results': False})
+      try:
+        cl = changelist(
+            request, self.model, list_display,
+            self.get_list_display_links(request, list_display),
+            self.get_list_filter(request), self.date_hierarchy,
+            self.get_search_fields(request), self.get_list_select_related(request),
+            self.list_per_page, self.list_max_show_all, self.list_editable, self)
+      except IncorrectLookupParameters:
+        return HttpResponseRedirect(request.path + '?' + ERROR_FLAG + '=1')
+      response = export_response(self, request, cl.queryset, fmt)
+      if response is None:
+        return HttpResponseRedirect(request.path + '?' + request.GET.urlencode())
+      return response
+
+    @csrf_protect_m
+    def delete_view(self, request, *args, **kwargs):
+      with self.batch_writes(request):
+        return super(NdbAdmin, self).delete_view(request, *args, **kwargs)
+
+    def get_urls(self):
+      info = self.model._meta.app_label, self.model._meta.model_name
+      return [
+          url(r'^import/$', self.admin_site.admin_view(self.import_view),
+              name='%s_%s_import' % info),
+      ] + super(NdbAdmin, self).get_urls()
+
+    @csrf_protect_m
+    def import_view(self, request):
+      """Imports an uploaded CSV or JSON lines file, as import_entities does.
+
+      The whole file is imported within the request; files too large for that
+      should be loaded with the command, which can also resume.
+      """
+      if not self.has_add_permission(request):
+        raise PermissionDenied
+      opts = self.model._meta
+      if request.method == 'POST':
+        form = importer.ImportForm(request.POST, request.FILES)
+        if form.is_valid():
+          imp = importer.Importer(self.model)
+          imp.import_rows(importer.read_rows(form.cleaned_data['file'],
+                                             form.cleaned_data['format']))
+          self.message_user(request, _("Imported %(count)d %(items)s, %(rate)d per second.") % {
+              "count": imp.imported, "items": model_ngettext(opts, imp.imported),
+              "rate": imp.rate
+          }, messages.SUCCESS)
+          if imp.error_count:
+            self.message_user(request, _("%(count)d rows were not imported: %(errors)s") % {
+                "count": imp.error_count,
+                "errors": '; '.join(_("row %(number)d: %(message)s") % {
+                    "number": number, "message": message
+                } for number, message in imp.errors[:IMPORT_ERRORS_SHOWN])
+            }, messages.WARNING)
+          return HttpResponseRedirect(reverse(
+              'admin:%s_%s_changelist' % (opts.app_label, opts.model_name),
+              current_app=self.admin_site.name))
+      else:
+        form = importer.ImportForm()
+      context = dict(
+          self.admin_site.each_context(request),
+          title=_('Import %s') % force_text(opts.verbose_name_plural),
+          opts=opts,
+          form=form,
+      )
+      request.current_app = self.admin_site.name
+      return TemplateResponse(request, [
+          "admin/%s/%s/ndb_import.html" % (opts.app_label, opts.model_name),
+          "admin/ndb_import.html",
+      ], context)
 
 
 class TabularNdbInline(BaseNdbAdmin, admin.TabularInline):
     formset = NdbBaseInlineFormSet
+    template = 'admin/edit_inline/ndb_tabular.html'
+    # The number of related objects to show at a time; None shows them all.
+    per_page = None
+
+    def get_formset(self, request, obj=None, **kwargs):
+      FormSet = super(TabularNdbInline, self).get_formset(request, obj, **kwargs)
+      FormSet.per_page = self.per_page
+      FormSet.request_params = request.GET
+      return FormSet
 
 
 def delete_selected(modeladmin, request, keys):
-  keys = [ndb.Key(urlsafe=k) for k in keys]
+  """Deletes the selected entities after asking for confirmation.
+
+  `keys` is the list of selected urlsafe keys, or the changelist query when the
+  user selected everything. The confirmation page only fetches a sample of the
+  entities. Deletion runs in bounded batches, and selections too large for one
+  request are handed to the task queue, with a Job to show progress.
+  """
   opts = modeladmin.model._meta
   app_label = opts.app_label
 
   # Check that the user has delete permission for the actual model
   if not modeladmin.has_delete_permission(request):
     raise PermissionDenied
+
+  select_across = isinstance(keys, ndb.Query)
+  if select_across:
+    query = keys
+  else:
+    keys = [ndb.Key(urlsafe=k) for k in keys]
+
   if request.POST.get('post'):
-      n = len(keys)
-      if n:
+      if select_across:
+        # The confirmation page posts the count it showed, so that the query
+        # isn't counted again; the bounded keys fetch catches a selection that
+        # grew, or a post without a count.
+        try:
+          n = int(request.POST.get('select_count'))
+        except (TypeError, ValueError):
+          n = 0
+        if n <= tasks.MAX_REQUEST_DELETES:
+          keys = query.fetch(tasks.MAX_REQUEST_DELETES + 1, keys_only=True)
+          n = len(keys)
+      else:
+        n = len(keys)
+      if n > tasks.MAX_REQUEST_DELETES:
+        job = tasks.start_delete(query if select_across else keys, n)
+        modeladmin.message_user(request, _("Deleting %(count)d %(items)s in the background; see %(job)s for progress.") % {
+            "count": n, "items": model_ngettext(modeladmin.opts, n), "job": job
+        }, messages.INFO)
+      elif n:
         #for obj in queryset:
             #obj_display = force_text(obj)
             #modeladmin.log_deletion(request, obj, obj_display)
-        ndb.delete_multi(keys)
+        tasks.delete_multi_batched(keys)
         modeladmin.message_user(request, _("Successfully deleted %(count)d %(items)s.") % {
             "count": n, "items": model_ngettext(modeladmin.opts, n)
         }, messages.SUCCESS)
       # Return None to display the change list page again.
       return None
 
-  deletable_objects = []
-  objects = ndb.get_multi(keys)
-  for obj in objects:
-    try:
-      admin_url = reverse('%s:%s_%s_change'
-                          % (modeladmin.admin_site.name,
-                             opts.app_label,
-                             opts.model_name),
-                          None, (obj.pk,))
-    except NoReverseMatch:
-      # Change url doesn't exist -- don't display link to edit
-      link = '%s: %s' % (capfirst(opts.verbose_name), force_text(obj))
-    else:
-      link =  format_html('{}: <a href="{}">{}</a>',
-                       capfirst(opts.verbose_name),
-                       admin_url,
-                       obj)
-    deletable_objects.append(link)
-  if len(keys) == 1:
+  if select_across:
+    # The count and the sample in parallel.
+    count = query.count_async()
+    sample = query.fetch_async(DELETE_CONFIRMATION_SAMPLE, keys_only=True)
+    n, sample = count.get_result(), sample.get_result()
+  else:
+    n = len(keys)
+    sample = keys[:DELETE_CONFIRMATION_SAMPLE]
+  objects = ndb.get_multi_async(sample)
+  try:
+    admin_url = reverse('%s:%s_%s_change'
+                        % (modeladmin.admin_site.name,
+                           opts.app_label,
+                           opts.model_name),
+                        None, (KEY_PLACEHOLDER,))
+  except NoReverseMatch:
+    # Change url doesn't exist -- don't display link to edit
+    admin_url = None
+
+  def deletable_objects():
+    # Rendered as the template iterates, once the sample has arrived.
+    for future in objects:
+      obj = future.get_result()
+      if obj is None:
+        continue
+      if admin_url is None:
+        yield '%s: %s' % (capfirst(opts.verbose_name), force_text(obj))
+      else:
+        yield format_html('{}: <a href="{}">{}</a>',
+                          capfirst(opts.verbose_name),
+                          admin_url.replace(KEY_PLACEHOLDER, obj.key.urlsafe()),
+                          obj)
+
+  if n == 1:
     objects_name = force_text(opts.verbose_name)
   else:
     objects_name = force_text(opts.verbose_name_plural)
@@ -286,9 +1138,12 @@ def delete_selected(modeladmin, request, keys):
     modeladmin.admin_site.each_context(request),
     title=title,
     objects_name=objects_name,
-    deletable_objects=[deletable_objects],
-    model_count=((objects_name, len(keys)),),
-    queryset=objects,
+    deletable_objects=deletable_objects(),
+    remaining_count=n - len(sample),
+    model_count=((objects_name, n),),
+    selected=[key.urlsafe() for key in (sample if select_across else keys)],
+    select_across=select_across,
+    select_count=n,
     #perms_lacking=perms_needed,
     #protected=protected,
     opts=opts,
@@ -302,16 +1157,57 @@ def delete_selected(modeladmin, request, keys):
   return TemplateResponse(request, modeladmin.delete_selected_confirmation_template or [
       "admin/%s/%s/delete_selected_confirmation.html" % (app_label, opts.model_name),
       "admin/%s/delete_selected_confirmation.html" % app_label,
-      "admin/delete_selected_confirmation.html"
+      "admin/ndb_delete_selected_confirmation.html"
   ], context)
 
 delete_selected.short_description = ugettext_lazy("Delete selected %(verbose_name_plural)s")
 
+
+def export_response(modeladmin, request, keys, fmt):
+  """Streams the entities as CSV or JSON lines.
+
+  `keys` is a list of urlsafe keys, or a query. A query matching more than
+  export.MAX_REQUEST_EXPORT entities is exported by a task instead, with a Job
+  that links to the output when it is done; then this returns None.
+  """
+  if isinstance(keys, ndb.Query):
+    n = keys.count(export.MAX_REQUEST_EXPORT + 1)
+    if n > export.MAX_REQUEST_EXPORT:
+      job = tasks.start_export(keys, fmt)
+      modeladmin.message_user(request, _("Exporting the %(items)s in the background; %(job)s will link to the file when it is done.") % {
+          "items": model_ngettext(modeladmin.opts, n), "job": job
+      }, messages.INFO)
+      return None
+  else:
+    keys = [ndb.Key(urlsafe=k) for k in keys]
+  response = StreamingHttpResponse(
+      export.lines(fmt, export.export_fields(modeladmin.opts), keys),
+      content_type=export.FORMATS[fmt])
+  response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (
+      modeladmin.model._get_kind(), fmt)
+  return response
+
+
+def export_csv(modeladmin, request, keys):
+  return export_response(modeladmin, request, keys, 'csv')
+
+export_csv.short_description = ugettext_lazy("Export selected %(verbose_name_plural)s as CSV")
+
+
+def export_jsonl(modeladmin, request, keys):
+  return export_response(modeladmin, request, keys, 'jsonl')
+
+export_jsonl.short_description = ugettext_lazy("Export selected %(verbose_name_plural)s as JSON lines")
+
 class NdbAdminSite(admin.AdminSite):
   def __init__(self, name='admin'):
     self._registry = {}  # model_class class -> admin_class instance
     self.name = name
-    self._actions = {'delete_selected': delete_selected}
+    self._actions = {
+        'delete_selected': delete_selected,
+        'export_csv': export_csv,
+        'export_jsonl': export_jsonl,
+    }
     self._global_actions = self._actions.copy()
   def register(self, model_or_iterable, admin_class=None, **options):
     if not admin_class:
@@ -321,9 +1217,46 @@ class NdbAdminSite(admin.AdminSite):
     return super(NdbAdminSite, self).register(model_or_iterable, admin_class, **options)
   def has_permission(self, request):
     return True
+  def index(self, request, extra_context=None):
+    """Shows the number, size and last update of each kind's entities.
+
+    They come from counters.get_kind_stats_async, which costs a single RPC
+    however many models are registered.
+    """
+    kinds = dict(((model._meta.app_label, model._meta.object_name), model._get_kind())
+                 for model in self._registry)
+    sharded_kinds = [model._get_kind() for model in self._registry
+                     if model._meta.sharded_count]
+    stats = counters.get_kind_stats_async(kinds.values(), sharded_kinds)
+    response = super(NdbAdminSite, self).index(request, extra_context)
+    stats = stats.get_result()
+    for app in response.context_data['app_list']:
+      for model_dict in app['models']:
+        kind = kinds.get((app['app_label'], model_dict['object_name']))
+        model_dict['stats'] = stats.get(kind)
+    return response
+  def get_urls(self):
+    urlpatterns = [
+        url(r'^choices/(?P<kind>\w+)/$', self.admin_view(views.key_choices),
+            name='key_choices'),
+        url(r'^export/(?P<job_id>[\w-]+)/(?P<filename>[\w.-]+)$',
+            self.admin_view(views.export_download), name='export_download'),
+    ]
+    return urlpatterns + super(NdbAdminSite, self).get_urls()
   def check_dependencies(self):
     pass
 
+class JobAdmin(NdbAdmin):
+  list_display = ('description', 'done', 'total', 'finished', 'updated', 'download')
+
+  def download(self, obj):
+    if obj.download_url:
+      return format_html('<a href="{}">{}</a>', obj.download_url, _('Download'))
+    return ''
+  download.short_description = ugettext_lazy('Output')
+
+
 site = NdbAdminSite()
 
 site.register([models.User])
+site.register(models.Job, JobAdmin)
@@ -0,0 +1,81 @@
+"""Collects the writes of a request so that they can be sent together."""
+import collections
+import functools
+
+from google.appengine.ext import ndb
+
+from meta import models
+
+# The most entities the datastore accepts in one put or delete call, and in one
+# transaction.
+WRITE_BATCH_SIZE = 500
+
+
+def _entity_group(key):
+  # Entities without a complete key or a parent are in a group of their own,
+  # which is not known until they are written.
+  if key is None or (key.parent() is None and key.id() is None):
+    return None
+  return key.root()
+
+
+@ndb.tasklet
+def _write_async(puts, deletes):
+  futures = []
+  for start in range(0, len(puts), WRITE_BATCH_SIZE):
+    futures.extend(ndb.put_multi_async(puts[start:start + WRITE_BATCH_SIZE]))
+  for start in range(0, len(deletes), WRITE_BATCH_SIZE):
+    futures.extend(ndb.delete_multi_async(deletes[start:start + WRITE_BATCH_SIZE]))
+  yield futures
+
+
+class WriteBatch(object):
+  """Entities to put and keys to delete, written together by flush().
+
+  Writes to the same entity group are made in one transaction, so they either
+  all happen or none do; the other writes are sent in as few put_multi and
+  delete_multi calls as the datastore allows. All of them are in flight at
+  once.
+  """
+  def __init__(self):
+    self.puts = []
+    self.deletes = []
+
+  def put(self, entity):
+    self.puts.append(entity)
+
+  def put_multi(self, entities):
+    self.puts.extend(entities)
+
+  def delete(self, key):
+    self.deletes.append(key)
+
+  def delete_multi(self, keys):
+    self.deletes.extend(keys)
+
+  @ndb.tasklet
+  def flush_async(self):
+    groups = collections.defaultdict(lambda: ([], []))
+    for entity in self.puts:
+      groups[_entity_group(entity.key)][0].append(entity)
+    for key in self.deletes:
+      groups[_entity_group(key)][1].append(key)
+    self.puts, self.deletes = [], []
+
+    loose_puts, loose_deletes = groups.pop(None, ([], []))
+    futures = []
+    for puts, deletes in groups.values():
+      if 1 < len(puts) + len(deletes) <= WRITE_BATCH_SIZE:
+        futures.append(ndb.transaction_async(
+            functools.partial(_write_async, puts, deletes)))
+      else:
+        loose_puts.extend(puts)
+        loose_deletes.extend(deletes)
+    futures.append(_write_async(loose_puts, loose_deletes))
+    yield futures
+
+  def flush(self):
+    """Writes everything, with one cache invalidation and counter update per kind."""
+    with models.bulk_writes() as bulk:
+      bulk.check_existing([entity.key for entity in self.puts if entity.key] + self.deletes)
+      self.flush_async().get_result()
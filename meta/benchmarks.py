@@ -0,0 +1,219 @@
+"""Benchmarks for the admin and forms layer.
+
+Each scenario is a function registered with @scenario, which takes the parsed
+options, does any setup such as seeding the datastore, and returns a callable
+to be timed. Apps can add scenarios in a `benchmarks` module of their own. Run
+them with `manage.py benchmark [scenario ...]`, which reports the wall time,
+the RPCs made and the peak memory of each, and can save them as JSON to
+compare runs across commits.
+
+Scenarios run against the testbed's datastore and memcache stubs. Those answer
+every call instantly and one at a time, so `--latency` adds a simulated round
+trip to every RPC, measured from when the call was made, which lets RPCs that
+are in flight together overlap as they would in production.
+"""
+import collections
+import contextlib
+import json
+import os
+import time
+import traceback
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+from django.http import HttpRequest
+from google.appengine.api import apiproxy_rpc
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+SCENARIOS = collections.OrderedDict()
+
+
+def scenario(func):
+  SCENARIOS[func.__name__] = func
+  return func
+
+
+@contextlib.contextmanager
+def stubs():
+  """Runs the enclosed code against fresh datastore and memcache stubs."""
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.init_datastore_v3_stub()
+  bed.init_memcache_stub()
+  ndb.get_context().clear_cache()
+  try:
+    yield bed
+  finally:
+    bed.deactivate()
+
+
+@contextlib.contextmanager
+def simulated_latency(seconds):
+  """Makes every RPC take at least `seconds` from when it was made."""
+  make_call = apiproxy_rpc.RPC._MakeCallImpl
+  wait = apiproxy_rpc.RPC._WaitImpl
+
+  def _MakeCallImpl(self):
+    self._made_at = time.time()
+    return make_call(self)
+
+  def _WaitImpl(self):
+    remaining = getattr(self, '_made_at', 0) + seconds - time.time()
+    if remaining > 0:
+      time.sleep(remaining)
+    return wait(self)
+
+  if seconds:
+    apiproxy_rpc.RPC._MakeCallImpl = _MakeCallImpl
+    apiproxy_rpc.RPC._WaitImpl = _WaitImpl
+  try:
+    yield
+  finally:
+    apiproxy_rpc.RPC._MakeCallImpl = make_call
+    apiproxy_rpc.RPC._WaitImpl = wait
+
+
+@contextlib.contextmanager
+def counted_rpcs():
+  """Counts the RPCs made in the enclosed code by service and method."""
+  counts = collections.Counter()
+
+  def count(service, call, request, response):
+    counts['%s.%s' % (service, call)] += 1
+
+  # The testbed installs a fresh stub map, so the hook goes with it.
+  hooks = apiproxy_stub_map.apiproxy.GetPreCallHooks()
+  hooks.Append('benchmark', count)
+  yield counts
+  counts['total'] = sum(counts.values())
+
+
+def peak_memory_kb():
+  if resource is None:
+    return None
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class BenchmarkError(Exception):
+  pass
+
+
+def run(name, options):
+  """Runs scenario `name` once and returns its measurements.
+
+  Returns a dict of the wall time in milliseconds, the RPCs made as counted by
+  counted_rpcs(), and the peak memory in KB once the scenario was set up and
+  once it had run. The scenario's own setup is not measured.
+  """
+  with stubs():
+    timed = SCENARIOS[name](options)
+    # Send what the setup left batched, such as its writes' cache
+    # invalidations, and start from cold caches, as a new request would.
+    ndb.get_context().flush().get_result()
+    ndb.get_context().clear_cache()
+    setup_memory = peak_memory_kb()
+    with simulated_latency(options['latency'] / 1000.0):
+      with counted_rpcs() as rpcs:
+        start = time.time()
+        timed()
+        elapsed = time.time() - start
+  return {
+      'wall_ms': elapsed * 1000,
+      'rpcs': dict(rpcs),
+      'setup_peak_memory_kb': setup_memory,
+      'peak_memory_kb': peak_memory_kb(),
+  }
+
+
+def run_isolated(name, options):
+  """Runs scenario `name` in a child process, and returns its measurements.
+
+  The peak memory of a process only ever grows, so each run gets a process of
+  its own; it starts as a copy of this one, so the figures are comparable
+  between scenarios of the same run.
+  """
+  if not hasattr(os, 'fork'):
+    return run(name, options)
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_fd)
+    try:
+      result, status = run(name, options), 0
+    except BaseException:
+      result, status = {'error': traceback.format_exc()}, 1
+    with os.fdopen(write_fd, 'w') as f:
+      json.dump(result, f)
+    os._exit(status)
+  os.close(write_fd)
+  with os.fdopen(read_fd) as f:
+    output = f.read()
+  os.waitpid(pid, 0)
+  if not output:
+    raise BenchmarkError('Scenario %s exited without a result.' % name)
+  result = json.loads(output)
+  if 'error' in result:
+    raise BenchmarkError('Scenario %s failed:\n%s' % (name, result['error']))
+  return result
+
+
+def _define_models(count, properties, eager):
+  from meta.models import DjangoCompatibleModel, NdbMeta, NdbModelMeta
+  models = []
+  for i in range(count):
+    attrs = {'p%d' % j: ndb.StringProperty() for j in range(properties)}
+    if i:
+      # A reference back, which the eager build can resolve as well.
+      attrs['ref'] = ndb.KeyProperty(kind='BenchmarkModel%d' % (i - 1))
+    attrs['__module__'] = __name__
+    models.append(NdbModelMeta('BenchmarkModel%d' % i, (DjangoCompatibleModel,), attrs))
+    if eager:
+      # What associate_to_model used to do at class creation.
+      NdbMeta.setup_all()
+  return models
+
+
+def _forget_models(models):
+  from meta.models import NdbMeta
+  for model in models:
+    ndb.Model._kind_map.pop(model._get_kind(), None)
+    if model._meta in NdbMeta.pending:
+      NdbMeta.pending.remove(model._meta)
+
+
+@scenario
+def startup_lazy(options):
+  """Defines models as an import does, with fields built on first use."""
+  def timed():
+    _forget_models(_define_models(options['models'], options['properties'], False))
+  return timed
+
+
+@scenario
+def startup_eager(options):
+  """Defines models and builds all their fields at once, as before."""
+  def timed():
+    _forget_models(_define_models(options['models'], options['properties'], True))
+  return timed
+
+
+@scenario
+def middleware(options):
+  """Authenticates a series of requests with GaeAuthenticationMiddleware."""
+  from meta.middleware import GaeAuthenticationMiddleware
+  # Restored when the testbed is deactivated.
+  os.environ.update(USER_EMAIL='benchmark@example.com', USER_ID='1',
+                    AUTH_DOMAIN='example.com')
+  middleware = GaeAuthenticationMiddleware()
+
+  def timed():
+    for i in range(options['requests']):
+      # Each request starts with an empty context cache.
+      ndb.get_context().clear_cache()
+      middleware.process_request(HttpRequest())
+  return timed
@@ -0,0 +1,94 @@
+import collections
+import hashlib
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+GENERATION_KEY = 'meta:generation:%s'
+STATS_KEY = 'meta:stats:%s:%s'
+# The caches whose hits and misses are counted; see count_lookup().
+STATS_PREFIXES = ('changelist', 'choices')
+
+
+def _seed():
+  # Seeding counters from the clock means a counter that is evicted from
+  # memcache never comes back at a value that older entries were stored under.
+  return int(time.time() * 1000)
+
+
+@ndb.tasklet
+def get_generation_async(kind):
+  """Returns the current cache generation for `kind`."""
+  context = ndb.get_context()
+  invalidation = getattr(context, '_meta_invalidations', {}).get(kind)
+  if invalidation is not None:
+    # So that this context reads what it has written.
+    yield invalidation
+  key = GENERATION_KEY % kind
+  generation = yield context.memcache_get(key)
+  if generation is None:
+    yield context.memcache_add(key, _seed())
+    generation = yield context.memcache_get(key)
+  raise ndb.Return(generation)
+
+
+def get_generation(kind):
+  return get_generation_async(kind).get_result()
+
+
+def invalidate_async(kind):
+  """Bumps the generation of `kind`, orphaning everything cached for it.
+
+  The increment is batched like the context's other memcache calls, and ndb
+  sends each key once per batch, so the invalidations of a put_multi take a
+  few RPCs however many entities it writes. Generations read later in the same
+  context wait for it.
+  """
+  context = ndb.get_context()
+  future = context.memcache_incr(GENERATION_KEY % kind, initial_value=_seed())
+  if not hasattr(context, '_meta_invalidations'):
+    context._meta_invalidations = {}
+  context._meta_invalidations[kind] = future
+  return future
+
+
+def invalidate(kind):
+  invalidate_async(kind).get_result()
+
+
+@ndb.tasklet
+def make_key_async(prefix, kind, *parts):
+  """Returns a memcache key for `parts` that is valid until `kind` is written."""
+  digest = hashlib.md5(repr(parts)).hexdigest()
+  generation = yield get_generation_async(kind)
+  raise ndb.Return('meta:%s:%s:%s:%s' % (prefix, kind, generation, digest))
+
+
+def make_key(prefix, kind, *parts):
+  return make_key_async(prefix, kind, *parts).get_result()
+
+
+def query_fingerprint(query):
+  """Returns a string telling `query` apart from others, for cache keys."""
+  # A query's repr leaves out its orders.
+  return '%r %r' % (query, query.orders)
+
+
+def count_lookup(prefix, hit):
+  """Counts a hit or a miss of the `prefix` cache, without waiting for it.
+
+  The increment goes out with the request's next batch of memcache calls.
+  """
+  return ndb.get_context().memcache_incr(
+      STATS_KEY % (prefix, 'hits' if hit else 'misses'), initial_value=0)
+
+
+def get_stats(prefixes=STATS_PREFIXES):
+  """Returns {prefix: (hits, misses)}, counted since memcache last evicted them."""
+  values = memcache.get_multi([STATS_KEY % (prefix, outcome) for prefix in prefixes
+                               for outcome in ('hits', 'misses')])
+  return collections.OrderedDict(
+      (prefix, (values.get(STATS_KEY % (prefix, 'hits'), 0),
+                values.get(STATS_KEY % (prefix, 'misses'), 0)))
+      for prefix in prefixes)
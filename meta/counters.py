@@ -0,0 +1,171 @@
+"""Ways of counting entities that are cheaper than Query.count().
+
+A datastore count is a keys-only scan of every matching entity, so on large
+kinds it is the slowest part of a changelist. The admin picks one of these
+strategies with NdbAdmin.count_strategy:
+
+  exact:   Query.count(), as Django would.
+  bounded: counts at most `limit` entities, shown as "1000+" beyond that.
+  stats:   the datastore's kind statistics, for unfiltered counts. These are
+           only refreshed about once a day, and are missing on the dev server.
+  sharded: a sharded counter that DjangoCompatibleModel keeps up to date, for
+           models whose Meta sets `sharded_count = True`.
+
+Filtered counts, and unfiltered ones the statistics can't answer, are bounded.
+get_kind_stats_async() gathers the same numbers for the admin's index page.
+"""
+import collections
+import hashlib
+import random
+
+from google.appengine.ext import ndb
+
+COUNTER_SHARDS = 20
+STATS_CACHE_TIME = 60 * 60
+# The index page's numbers are cached for less, as the counters move.
+KIND_STATS_CACHE_TIME = 60
+
+
+class BoundedCount(int):
+  """A count that stopped at its limit, and displays as e.g. "1000+"."""
+  def __unicode__(self):
+    return u'%d+' % self
+
+  def __str__(self):
+    return '%d+' % self
+
+
+class KindStat(ndb.Model):
+  """The datastore's statistics for one kind, keyed by the kind name."""
+  kind_name = ndb.StringProperty()
+  count = ndb.IntegerProperty()
+  bytes = ndb.IntegerProperty()
+  timestamp = ndb.DateTimeProperty()
+
+  @classmethod
+  def _get_kind(cls):
+    return '__Stat_Kind__'
+
+
+class KindCounterShard(ndb.Model):
+  """One shard of the count of a kind's entities, keyed by kind and shard."""
+  count = ndb.IntegerProperty(default=0, indexed=False)
+  updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+# The number and total size of a kind's entities, and when they last changed;
+# each is None if unknown.
+KindStats = collections.namedtuple('KindStats', 'count bytes updated')
+
+
+@ndb.tasklet
+def bounded_count_async(query, limit):
+  count = yield query.count_async(limit + 1)
+  if count > limit:
+    raise ndb.Return(BoundedCount(limit))
+  raise ndb.Return(count)
+
+
+@ndb.tasklet
+def get_stats_count_async(kind):
+  """Returns the number of entities of `kind` from the kind statistics."""
+  context = ndb.get_context()
+  cache_key = 'meta:stats_count:%s' % kind
+  count = yield context.memcache_get(cache_key)
+  if count is None:
+    stat = yield KindStat.get_by_id_async(kind)
+    if stat is None:
+      raise ndb.Return(None)
+    count = stat.count
+    yield context.memcache_set(cache_key, count, STATS_CACHE_TIME)
+  raise ndb.Return(count)
+
+
+def _shard_keys(kind):
+  return [ndb.Key(KindCounterShard, '%s:%d' % (kind, i))
+          for i in range(COUNTER_SHARDS)]
+
+
+@ndb.tasklet
+def get_sharded_count_async(kind):
+  """Returns the sum of the counter shards of `kind`, with a single get."""
+  shards = yield ndb.get_multi_async(_shard_keys(kind))
+  raise ndb.Return(sum(shard.count for shard in shards if shard))
+
+
+@ndb.transactional(propagation=ndb.TransactionOptions.INDEPENDENT)
+def _increment_shard(key, delta):
+  shard = key.get() or KindCounterShard(key=key)
+  shard.count += delta
+  shard.put()
+
+
+def increment(kind, delta):
+  """Adds `delta` to a random shard of the counter of `kind`."""
+  _increment_shard(random.choice(_shard_keys(kind)), delta)
+
+
+@ndb.tasklet
+def count_async(query, strategy='exact', limit=1000, filtered=True):
+  """Returns the number of entities matching `query` using `strategy`.
+
+  `filtered` says whether the query has filters beyond the kind, which rules
+  out the stats and sharded strategies.
+  """
+  if strategy == 'exact':
+    result = yield query.count_async()
+    raise ndb.Return(result)
+  if not filtered:
+    result = None
+    if strategy == 'stats':
+      result = yield get_stats_count_async(query.kind)
+    elif strategy == 'sharded':
+      result = yield get_sharded_count_async(query.kind)
+    if result is not None:
+      raise ndb.Return(result)
+  result = yield bounded_count_async(query, limit)
+  raise ndb.Return(result)
+
+
+def count(*args, **kwargs):
+  return count_async(*args, **kwargs).get_result()
+
+
+@ndb.tasklet
+def get_kind_stats_async(kinds, sharded_kinds=()):
+  """Returns {kind: KindStats} for each of `kinds`, cached for a minute.
+
+  The counts of `sharded_kinds` come from their counters, whose shards also
+  record when the kind was last written. The other counts, and all the sizes,
+  come from the datastore's statistics, which are a day old at most and whose
+  timestamp is given instead. The statistics and the shards of every kind are
+  read with a single get, bypassing ndb's caches, which would cost a memcache
+  call of their own.
+  """
+  context = ndb.get_context()
+  kinds = sorted(kinds)
+  sharded_kinds = sorted(set(sharded_kinds) & set(kinds))
+  cache_key = 'meta:kind_stats:%s' % hashlib.md5(repr((kinds, sharded_kinds))).hexdigest()
+  result = yield context.memcache_get(cache_key)
+  if result is not None:
+    raise ndb.Return(result)
+  keys = [ndb.Key(KindStat, kind) for kind in kinds]
+  for kind in sharded_kinds:
+    keys.extend(_shard_keys(kind))
+  entities = yield ndb.get_multi_async(keys, use_cache=False, use_memcache=False)
+  result = {}
+  for kind, stat in zip(kinds, entities):
+    if stat is None:
+      result[kind] = KindStats(None, None, None)
+    else:
+      result[kind] = KindStats(stat.count, stat.bytes, stat.timestamp)
+  shards = entities[len(kinds):]
+  for i, kind in enumerate(sharded_kinds):
+    kind_shards = [shard for shard in shards[i * COUNTER_SHARDS:(i + 1) * COUNTER_SHARDS]
+                   if shard]
+    updated = [shard.updated for shard in kind_shards if shard.updated]
+    result[kind] = result[kind]._replace(
+        count=sum(shard.count for shard in kind_shards),
+        updated=max(updated) if updated else result[kind].updated)
+  yield context.memcache_set(cache_key, result, KIND_STATS_CACHE_TIME)
+  raise ndb.Return(result)
@@ -0,0 +1,110 @@
+"""Exports of entities as CSV or JSON lines, written a batch at a time.
+
+Entities are read in pages of EXPORT_BATCH_SIZE, the next page being fetched
+while the current one is written, so memory stays flat however many there
+are. Each property is exported as its PropertyWrapper.value_from_object gives
+it, with keys as urlsafe strings.
+"""
+import collections
+import csv
+import datetime
+import json
+
+from django.utils.encoding import force_bytes
+from google.appengine.ext import ndb
+
+EXPORT_BATCH_SIZE = 500
+# App Engine buffers a response before sending it, up to 32MB, within the
+# request deadline; larger exports are written by a task instead.
+MAX_REQUEST_EXPORT = 20000
+
+FORMATS = collections.OrderedDict([
+  ('csv', 'text/csv; charset=utf-8'),
+  ('jsonl', 'application/x-ndjson; charset=utf-8'),
+])
+
+
+def export_fields(opts):
+  """Returns the field wrappers to export, the key first."""
+  return [field for field in opts.local_fields
+          if field.editable or field.primary_key]
+
+
+def json_value(value):
+  if isinstance(value, ndb.Key):
+    return value.urlsafe()
+  if isinstance(value, (datetime.date, datetime.time)):
+    return value.isoformat()
+  if isinstance(value, ndb.Model):
+    return json_value(value.to_dict())
+  if isinstance(value, dict):
+    return dict((k, json_value(v)) for k, v in value.items())
+  if isinstance(value, (list, tuple)):
+    return [json_value(v) for v in value]
+  if isinstance(value, str):
+    # A BlobProperty; anything but text is not worth exporting as a string.
+    return value.decode('utf-8', 'replace')
+  return value
+
+
+def csv_value(value):
+  value = json_value(value)
+  if value is None:
+    return ''
+  if isinstance(value, (dict, list)):
+    return json.dumps(value)
+  return force_bytes(value)
+
+
+def iter_entities(keys_or_query, batch_size=EXPORT_BATCH_SIZE, cursor=None):
+  """Yields the entities for a list of keys, or matching a query.
+
+  For a query, yields (entity, cursor) pairs, where the cursor is the position
+  after the entity's page, for a task to carry on from.
+  """
+  if isinstance(keys_or_query, ndb.Query):
+    future = keys_or_query.fetch_page_async(batch_size, start_cursor=cursor)
+    while future is not None:
+      results, cursor, more = future.get_result()
+      future = None
+      if more and cursor:
+        future = keys_or_query.fetch_page_async(batch_size, start_cursor=cursor)
+      for entity in results:
+        yield entity, cursor if more else None
+  else:
+    keys = keys_or_query
+    futures = ndb.get_multi_async(keys[:batch_size])
+    for start in range(0, len(keys), batch_size):
+      batch = futures
+      futures = ndb.get_multi_async(keys[start + batch_size:start + 2 * batch_size])
+      for future in batch:
+        entity = future.get_result()
+        if entity is not None:
+          yield entity, None
+
+
+class Echo(object):
+  """A file-like object for csv.writer that returns what it is given."""
+  def write(self, value):
+    return value
+
+
+def header(fmt, fields):
+  if fmt == 'csv':
+    return csv.writer(Echo()).writerow([field.name for field in fields])
+  return ''
+
+
+def line(fmt, fields, entity):
+  if fmt == 'csv':
+    return csv.writer(Echo()).writerow(
+        [csv_value(field.value_from_object(entity)) for field in fields])
+  return json.dumps(collections.OrderedDict(
+      (field.name, json_value(field.value_from_object(entity))) for field in fields)) + '\n'
+
+
+def lines(fmt, fields, keys_or_query):
+  """Yields the header and the rows of an export, as byte strings."""
+  yield header(fmt, fields)
+  for entity, cursor in iter_entities(keys_or_query):
+    yield line(fmt, fields, entity)
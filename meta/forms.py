@@ -1,12 +1,108 @@
+import cPickle as pickle
+import datetime
+import json
+
 from django import forms
 from django.core.exceptions import ValidationError
+from django.core.urlresolvers import NoReverseMatch, reverse
 from django.forms.models import InlineForeignKeyField
+from django.http import QueryDict
+from django.template.defaultfilters import filesizeformat
+from django.utils.encoding import force_text
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
 from django.utils.text import capfirst
+from django.utils.translation import ugettext_lazy as _
 
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
+from meta import cache
+from meta import export
+from meta.prefetch import get_prefetched, get_prefetched_multi, prefetch
+
+# Dates and times are exported in ISO 8601; Django's default input formats
+# lack the 'T' separator.
+ISO_DATETIME_FORMATS = ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M']
+ISO_TIME_FORMATS = ['%H:%M:%S.%f', '%H:%M:%S', '%H:%M']
+
+
+def prefetch_submitted_keys(forms_):
+  """Starts one batch get for the keys submitted to the KeyFields of `forms_`.
+
+  KeyField.to_python then checks each key against that batch, so validating a
+  whole formset costs a single RPC.
+  """
+  keys = []
+  for form in forms_:
+    if not form.is_bound:
+      continue
+    for name, field in form.fields.items():
+      if isinstance(field, KeyField):
+        keys.extend(field.submitted_keys(form[name].data))
+  prefetch(keys)
+
+
+class NdbModelForm(forms.ModelForm):
+  def full_clean(self):
+    prefetch_submitted_keys([self])
+    super(NdbModelForm, self).full_clean()
+
 
 class NdbBaseModelFormSet(forms.BaseModelFormSet):
+  def full_clean(self):
+    if self.is_bound:
+      prefetch_submitted_keys(self.forms)
+    super(NdbBaseModelFormSet, self).full_clean()
+
+  def submitted_keys(self):
+    """Returns the keys of the existing objects submitted to the formset."""
+    keys = []
+    for i in range(self.initial_form_count()):
+      # _construct_form asks for the first object before add_fields has set
+      # self._pk_field.
+      value = self.data.get('%s-%s' % (self.add_prefix(i), self.model._meta.pk.name))
+      if value:
+        try:
+          keys.append(ndb.Key(urlsafe=value))
+        except Exception:
+          # The pk field reports these
+          continue
+    return keys
+
+  def get_queryset(self):
+    # The changelist passes its page of results as a list.
+    if not hasattr(self, '_queryset'):
+      qs = self.queryset
+      if isinstance(qs, ndb.Query):
+        if not qs.orders:
+          qs = qs.order(self.model.key)
+        qs = qs.fetch()
+      self._queryset = list(qs)
+    return self._queryset
+
+  def is_existing_object(self, obj):
+    return obj is not None and obj.key.kind() == self.model._get_kind()
+
+  def _existing_object(self, pk):
+    # Rather than loading the whole queryset to find the submitted objects,
+    # fetch exactly those in one batch.
+    if not hasattr(self, '_object_dict'):
+      keys = self.submitted_keys()
+      self._object_dict = dict(
+          (key, obj) for key, obj in zip(keys, get_prefetched_multi(keys))
+          if self.is_existing_object(obj))
+    return self._object_dict.get(pk)
+
+  def save(self, commit=True):
+    """Saves all the changed objects with one put_multi call."""
+    instances = super(NdbBaseModelFormSet, self).save(commit=False)
+    if commit:
+      ndb.put_multi(instances)
+      ndb.delete_multi([obj.key for obj in self.deleted_objects])
+    return instances
+
   def add_pk_field(self, form, index):
     # Key field is never editable in an NDB model.
     if form.is_bound:
@@ -35,20 +131,166 @@ class NdbBaseInlineFormSet(forms.BaseInlineFormSet, NdbBaseModelFormSet):
         self.fk.property._kind, 'theresnowaythiscouldeverbearealkey'))
     return qs
 
+  # The number of related objects to show at a time, or None for all of them.
+  per_page = None
+  # The change view's GET parameters, which hold the cursor for each inline.
+  request_params = QueryDict()
+
+  def __init__(self, *args, **kwargs):
+    super(NdbBaseInlineFormSet, self).__init__(*args, **kwargs)
+    if not self.is_bound:
+      # Started now so that the queries of all the inlines on a page run
+      # concurrently.
+      self._page = self.get_page_async()
+
+  def is_existing_object(self, obj):
+    # Only objects which really belong to the parent can be edited through it.
+    return (super(NdbBaseInlineFormSet, self).is_existing_object(obj) and
+            getattr(obj, self.fk.name) == self.instance.key)
+
+  @ndb.tasklet
+  def get_page_async(self):
+    """Returns (objects, next_cursor) for the requested page of the inline."""
+    if self.queryset is not None:
+      qs = self.queryset
+    else:
+      qs = self.model._default_manager.get_queryset()
+    if not qs.orders:
+      qs = qs.order(self.model.key)
+    if self.per_page is None:
+      objects = yield qs.fetch_async()
+      raise ndb.Return((objects, None))
+    try:
+      cursor = self.request_params.get('%s-cursor' % self.prefix)
+      cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    except datastore_errors.BadValueError:
+      cursor = None
+    objects, next_cursor, more = yield qs.fetch_page_async(
+        self.per_page, start_cursor=cursor)
+    raise ndb.Return((objects, next_cursor if more else None))
+
+  def next_page_query(self):
+    """Returns the query string of the next page, keeping the other parameters."""
+    params = self.request_params.copy()
+    params['%s-cursor' % self.prefix] = self.next_cursor.urlsafe()
+    return params.urlencode()
+
   def get_queryset(self):
-    if not hasattr(self, '_queryset'):
-      if self.queryset is not None:
-        qs = self.queryset
-      else:
-        qs = self.model._default_manager.get_queryset()
-      if not qs.orders:
-        qs = qs.order(self.model.key)
-      self._queryset = qs
-    return self._queryset.fetch()
+    if not hasattr(self, '_page'):
+      self._page = self.get_page_async()
+    objects, self.next_cursor = self._page.get_result()
+    return objects
+
+
+@ndb.tasklet
+def get_key_choices_async(query, limit=None):
+  """Returns (urlsafe key, label) pairs for the entities matching `query`.
+
+  If the model declares `label_fields` in its Meta, the labels are loaded with a
+  projection on those properties rather than by decoding whole entities; note
+  that a projection skips entities which have no value for them. Returns None
+  if `limit` is given and more entities than that match. Either way the result
+  is cached until the kind is next written, unless it is too large for memcache.
+  """
+  context = ndb.get_context()
+  cache_key = yield cache.make_key_async(
+      'choices', query.kind, cache.query_fingerprint(query), limit)
+  cached = yield context.memcache_get(cache_key)
+  cache.count_lookup('choices', cached is not None)
+  if cached is not None:
+    raise ndb.Return(cached['choices'])
+  if limit is not None:
+    count = yield query.count_async(limit + 1)
+  if limit is not None and count > limit:
+    choices = None
+  else:
+    options = {}
+    model = ndb.Model._kind_map.get(query.kind)
+    label_fields = getattr(getattr(model, '_meta', None), 'label_fields', None)
+    if label_fields and query.filters is None and not query.orders:
+      options['projection'] = label_fields
+    entities = yield query.fetch_async(**options)
+    choices = [(x.key.urlsafe(), unicode(x)) for x in entities]
+  value = {'choices': choices}
+  # memcache would reject a larger value, failing the other sets of its batch.
+  if len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) <= memcache.MAX_VALUE_SIZE:
+    yield context.memcache_set(cache_key, value)
+  raise ndb.Return(choices)
+
+
+def get_key_choices(query, limit=None):
+  return get_key_choices_async(query, limit).get_result()
+
+
+def _is_select(widget):
+  if isinstance(widget, type):
+    return issubclass(widget, forms.Select)
+  return isinstance(widget, forms.Select)
+
+
+class KeySearchInput(forms.TextInput):
+  """Text input for urlsafe keys, offering matching entities as the user types.
+
+  Used instead of a select once a kind is too large to list inline. With
+  `multiple`, the input holds a comma-separated list of keys.
+  """
+  def __init__(self, kind, multiple=False, attrs=None):
+    self.kind = kind
+    self.multiple = multiple
+    super(KeySearchInput, self).__init__(attrs)
+
+  class Media:
+    js = ('meta/key_search.js',)
+
+  def get_choices_url(self):
+    try:
+      return reverse('admin:key_choices', kwargs={'kind': self.kind})
+    except NoReverseMatch:
+      return None
+
+  def label_for_value(self, value):
+    keys = []
+    for v in value.split(','):
+      try:
+        keys.append(ndb.Key(urlsafe=v))
+      except Exception:
+        # The field reports these
+        continue
+    # Served from the batch the field prefetched for validation, if any.
+    objects = [obj for obj in get_prefetched_multi(keys) if obj is not None]
+    if objects:
+      return format_html('&nbsp;<strong>{}</strong>',
+                         ', '.join(force_text(obj) for obj in objects))
+    return ''
+
+  def render(self, name, value, attrs=None):
+    attrs = dict(attrs or {})
+    if self.multiple and value:
+      value = ','.join(value)
+    url = self.get_choices_url()
+    if url:
+      attrs['data-choices-url'] = url
+      attrs['class'] = 'vKeySearchField'
+      if self.multiple:
+        attrs['data-multiple'] = '1'
+    output = [super(KeySearchInput, self).render(name, value, attrs)]
+    if value:
+      output.append(self.label_for_value(value))
+    return mark_safe(''.join(output))
+
+  def value_from_datadict(self, data, files, name):
+    value = data.get(name)
+    if self.multiple and value:
+      return [v.strip() for v in value.split(',') if v.strip()]
+    return value
 
 
 class KeyField(forms.ChoiceField):
   multiple = False
+  # Kinds with more entities than this are not listed in a select; the field
+  # uses a KeySearchInput that queries the admin choices view instead.
+  max_inline_choices = 500
+
   def __init__(self, *args, **kwargs):
     self.kind = kwargs.pop('kind')
     if not isinstance(self.kind, basestring):
@@ -61,23 +303,35 @@ class KeyField(forms.ChoiceField):
       self.empty_label = None
     else:
       self.empty_label = kwargs.pop('empty_label', "---------")
+    choices = []
+    if _is_select(kwargs.get('widget') or self.widget):
+      # An explicitly requested select gets every choice, however many.
+      limit = None if kwargs.get('widget') else self.max_inline_choices
+      choices = get_key_choices(self.query, limit)
+      if choices is None:
+        kwargs['widget'] = KeySearchInput(self.kind, multiple=self.multiple)
+        choices = []
+      elif not kwargs.get('required', True) and not self.multiple:
+        choices.insert(0, (None, self.empty_label))
     forms.Field.__init__(self, *args, **kwargs)
-    self.widget.choices = self.choices
+    self.choices = choices
 
-  def _get_choices(self):
-    if not hasattr(self, '_choices'):
-      self._choices = [(x.key.urlsafe(), unicode(x)) for x in self.query.fetch()]
-      if not self.required and not self.multiple:
-        self._choices.insert(0, (None, self.empty_label))
-    return self._choices
-
-  choices = property(_get_choices, forms.ChoiceField._set_choices)
+  def submitted_keys(self, value):
+    """Returns the keys in the raw submitted `value`, ignoring invalid ones."""
+    keys = []
+    for v in (value if self.multiple else [value]) or []:
+      try:
+        keys.append(ndb.Key(urlsafe=v))
+      except Exception:
+        # to_python reports these
+        continue
+    return keys
 
   def to_python(self, value):
     if value:
       value = ndb.Key(urlsafe=value)
-      instance = value.get()
-      if not instance:
+      # Served from the batch started by prefetch_submitted_keys, if any.
+      if value.kind() != self.kind or get_prefetched(value) is None:
         raise ValidationError(self.error_messages['invalid_choice'],
                               code='invalid_choice')
     return value or None
@@ -98,8 +352,131 @@ class MultipleKeyField(KeyField):
 
   def to_python(self, values):
     if values:
+      prefetch(self.submitted_keys(values))
       return [super(MultipleKeyField, self).to_python(val) for val in values]
 
   def prepare_value(self, values):
     if values:
       return [super(MultipleKeyField, self).prepare_value(val) for val in values]
+
+
+class BlobInput(forms.FileInput):
+  """A file input that shows the size of the current value."""
+  def render(self, name, value, attrs=None):
+    output = super(BlobInput, self).render(name, None, attrs)
+    if value:
+      return format_html('{} {}<br />', _('Currently:'), filesizeformat(len(value))) + output
+    return output
+
+
+class BlobField(forms.FileField):
+  """Takes a BlobProperty's value as an upload; without one, the value is kept."""
+  widget = BlobInput
+
+  def to_python(self, data):
+    data = super(BlobField, self).to_python(data)
+    return data.read() if data else None
+
+
+class SubmittedJson(unicode):
+  """Text submitted to a JsonField, which is redisplayed as it was typed."""
+
+
+class JsonField(forms.CharField):
+  """Edits a JsonProperty as JSON text."""
+  widget = forms.Textarea
+  default_error_messages = {
+    'invalid': _('Enter valid JSON.'),
+  }
+
+  def bound_data(self, data, initial):
+    return SubmittedJson(data or '')
+
+  def prepare_value(self, value):
+    if isinstance(value, SubmittedJson):
+      return value
+    if value is None:
+      return ''
+    return json.dumps(export.json_value(value), indent=2, sort_keys=True)
+
+  def to_python(self, value):
+    value = super(JsonField, self).to_python(value)
+    if not value:
+      return None
+    try:
+      return json.loads(value)
+    except ValueError:
+      raise ValidationError(self.error_messages['invalid'], code='invalid')
+
+  def has_changed(self, initial, data):
+    try:
+      return self.to_python(data) != initial
+    except ValidationError:
+      return True
+
+
+def _value_from_json(prop, value):
+  if value is None:
+    return None
+  if isinstance(prop, ndb.KeyProperty):
+    return ndb.Key(urlsafe=value)
+  if isinstance(prop, ndb.DateProperty):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+  if isinstance(prop, (ndb.DateTimeProperty, ndb.TimeProperty)):
+    formats = ISO_TIME_FORMATS if isinstance(prop, ndb.TimeProperty) else ISO_DATETIME_FORMATS
+    for fmt in formats:
+      try:
+        parsed = datetime.datetime.strptime(value, fmt)
+      except ValueError:
+        continue
+      return parsed.time() if isinstance(prop, ndb.TimeProperty) else parsed
+    raise ValueError('%r is not an ISO 8601 date and time' % value)
+  if isinstance(prop, ndb.StructuredProperty):
+    return model_from_json(prop._modelclass, value)
+  return value
+
+
+def model_from_json(modelclass, data):
+  """Builds a `modelclass` instance from the JSON that export.json_value makes of one.
+
+  Raises ValueError, TypeError or a datastore_errors.Error if it doesn't fit.
+  """
+  if not isinstance(data, dict):
+    raise ValueError('%s is not an object' % json.dumps(data))
+  properties = dict((prop._code_name, prop) for prop in modelclass._properties.values())
+  values = {}
+  for name, value in data.items():
+    prop = properties.get(name)
+    if prop is None:
+      raise ValueError('%s has no property %s' % (modelclass.__name__, name))
+    if prop._repeated:
+      values[name] = [_value_from_json(prop, v) for v in value or []]
+    else:
+      values[name] = _value_from_json(prop, value)
+  return modelclass(**values)
+
+
+class StructuredField(JsonField):
+  """Edits a StructuredProperty or LocalStructuredProperty as JSON text."""
+  default_error_messages = {
+    'invalid_structure': _('Enter JSON matching %(model)s: %(error)s'),
+  }
+
+  def __init__(self, *args, **kwargs):
+    self.modelclass = kwargs.pop('modelclass')
+    self.repeated = kwargs.pop('repeated', False)
+    super(StructuredField, self).__init__(*args, **kwargs)
+
+  def to_python(self, value):
+    data = super(StructuredField, self).to_python(value)
+    if data is None:
+      return [] if self.repeated else None
+    try:
+      if self.repeated:
+        if not isinstance(data, list):
+          raise ValueError('%s is not a list' % json.dumps(data))
+        return [model_from_json(self.modelclass, item) for item in data]
+      return model_from_json(self.modelclass, data)
+    except (ValueError, TypeError, datastore_errors.Error) as e:
+      raise ValidationError(self.error_messages['invalid_structure'], code='invalid',
+                            params={'model': self.modelclass.__name__, 'error': e})
@@ -0,0 +1,282 @@
+"""Bulk imports of CSV or JSON lines into a DjangoCompatibleModel kind.
+
+Rows are read one at a time, in the formats meta.export writes, and validated
+in batches through a ModelForm built from the model's field wrappers, so an
+import accepts what the admin's forms accept. Each batch costs one get, for
+the entities its rows update and the keys they reference, and one put_multi;
+several batches are written while the next ones are validated.
+
+The checkpoint is the number of input rows whose batches have all been
+written, and an import resumed from it skips that many rows. Rows without a
+key are inserted with new ids, so those of the batches in flight when an
+import stopped are inserted again when it resumes.
+"""
+import collections
+import csv
+import itertools
+import json
+import os
+import time
+
+from django import forms
+from django.forms.models import modelform_factory
+from django.utils.datastructures import MultiValueDict
+from django.utils.translation import ugettext_lazy as _
+from google.appengine.ext import ndb
+
+from meta import export
+from meta import models
+from meta import prefetch
+from meta.forms import ISO_DATETIME_FORMATS, KeyField, MultipleKeyField, NdbModelForm
+
+IMPORT_BATCH_SIZE = 500
+# How many batches are being written before waiting for the oldest one.
+MAX_BATCHES_IN_FLIGHT = 10
+# Only the first errors are kept; the others are only counted.
+MAX_REPORTED_ERRORS = 100
+
+KEY_COLUMN = 'key'
+
+
+def guess_format(filename):
+  """Returns the import format for `filename` from its extension, or None."""
+  fmt = os.path.splitext(filename)[1].lstrip('.').lower()
+  return fmt if fmt in export.FORMATS else None
+
+
+def read_rows(fileobj, fmt):
+  """Yields each row of a CSV or JSON lines file as a dict."""
+  if fmt == 'csv':
+    for row in csv.DictReader(fileobj):
+      # Values beyond the header are under None, and missing ones are None.
+      yield dict((name.decode('utf-8'), (value or '').decode('utf-8'))
+                 for name, value in row.items() if name is not None)
+  else:
+    for line in fileobj:
+      if line.strip():
+        yield json.loads(line)
+
+
+class BlobTextField(forms.CharField):
+  """Takes a blob as the text that the export wrote for it."""
+  def to_python(self, value):
+    value = super(BlobTextField, self).to_python(value)
+    return value.encode('utf-8') if value else None
+
+
+def import_formfield(field, **kwargs):
+  """Builds the fields of the import forms, which take values as exported.
+
+  Keys are validated against the batch get rather than a list of choices.
+  """
+  if isinstance(field, models.BlobPropertyWrapper):
+    return BlobTextField(required=not field.blank, strip=False)
+  if isinstance(field, models.KeyPropertyWrapper):
+    kwargs['widget'] = (forms.MultipleHiddenInput if field.property._repeated
+                        else forms.TextInput)
+  formfield = field.formfield(**kwargs)
+  if isinstance(formfield, forms.DateTimeField):
+    formfield.input_formats = list(formfield.input_formats) + ISO_DATETIME_FORMATS
+  return formfield
+
+
+def form_data(row, form_class):
+  """Returns `row` as the data of a `form_class` form.
+
+  A repeated key is a list in JSON lines, and a JSON list or comma-separated
+  keys in CSV.
+  """
+  data = MultiValueDict()
+  for name, value in row.items():
+    field = form_class.base_fields.get(name)
+    if field is None or value is None:
+      continue
+    if isinstance(field, MultipleKeyField):
+      if isinstance(value, basestring):
+        if value.startswith('['):
+          value = json.loads(value)
+        else:
+          value = [v.strip() for v in value.split(',') if v.strip()]
+      data.setlist(name, value)
+    elif isinstance(value, (dict, list)):
+      # A JSON or structured property, which its field takes as JSON text.
+      data[name] = json.dumps(value)
+    else:
+      data[name] = value
+  return data
+
+
+def referenced_keys(data, form_class):
+  keys = []
+  for name, field in form_class.base_fields.items():
+    if isinstance(field, MultipleKeyField):
+      keys.extend(field.submitted_keys(data.getlist(name)))
+    elif isinstance(field, KeyField):
+      keys.extend(field.submitted_keys(data.get(name)))
+  return keys
+
+
+class Importer(object):
+  """Imports rows into `model`; see import_rows().
+
+  `on_checkpoint` is called with the importer each time a batch has been
+  written, when `checkpoint`, `imported` and `rate` have moved on.
+  """
+  def __init__(self, model, batch_size=IMPORT_BATCH_SIZE,
+               max_in_flight=MAX_BATCHES_IN_FLIGHT, on_checkpoint=None):
+    self.model = model
+    self.batch_size = batch_size
+    self.max_in_flight = max_in_flight
+    self.on_checkpoint = on_checkpoint
+    self.checkpoint = 0
+    self.imported = 0
+    self.error_count = 0
+    self.errors = []
+    self.started = None
+    self._form_classes = {}
+    self._in_flight = collections.deque()
+    self._bulk = None
+
+  @property
+  def rate(self):
+    """The entities written per second so far."""
+    elapsed = time.time() - self.started if self.started else 0
+    return self.imported / elapsed if elapsed > 0 else 0.0
+
+  def add_error(self, number, message):
+    self.error_count += 1
+    if len(self.errors) < MAX_REPORTED_ERRORS:
+      self.errors.append((number, message))
+
+  def get_form_class(self, columns):
+    """Returns the ModelForm for the editable fields among `columns`."""
+    columns = frozenset(columns)
+    if columns not in self._form_classes:
+      opts = self.model._meta
+      fields = [field.name for field in opts.local_fields
+                if field.editable and field is not opts.pk and field.name in columns]
+      self._form_classes[columns] = modelform_factory(
+          self.model, form=NdbModelForm, fields=fields,
+          formfield_callback=import_formfield)
+    return self._form_classes[columns]
+
+  def missing_fields(self, entity):
+    """Returns the required fields `entity` has no value for.
+
+    A form only has the fields among the row's columns, so its put would
+    otherwise fail for the whole batch.
+    """
+    return [field for field in self.model._meta.local_fields
+            if field is not self.model._meta.pk and not field.blank and
+            field.value_from_object(entity) in (None, [])]
+
+  def get_key(self, row):
+    value = row.get(KEY_COLUMN)
+    if not value:
+      return None
+    try:
+      key = ndb.Key(urlsafe=value)
+    except Exception:
+      raise ValueError('%s: not a valid key' % KEY_COLUMN)
+    if key.kind() != self.model._get_kind():
+      raise ValueError('%s: not a %s key' % (KEY_COLUMN, self.model._get_kind()))
+    return key
+
+  def import_rows(self, rows, skip=0):
+    """Imports `rows`, after skipping the first `skip` of them."""
+    self.checkpoint = skip
+    self.started = time.time()
+    context = ndb.get_context()
+    cache_policy = context.get_cache_policy()
+    # Otherwise every entity written stays in the context cache.
+    context.set_cache_policy(False)
+    try:
+      with models.bulk_writes() as self._bulk:
+        batch = []
+        for number, row in enumerate(itertools.islice(rows, skip, None), skip + 1):
+          batch.append((number, row))
+          if len(batch) >= self.batch_size:
+            self.start_batch(batch)
+            batch = []
+        if batch:
+          self.start_batch(batch)
+        while self._in_flight:
+          self.finish_oldest_batch()
+    finally:
+      self._bulk = None
+      context.set_cache_policy(cache_policy)
+      # Entities cached before the import may have been overwritten.
+      context.clear_cache()
+      prefetch.clear()
+    return self
+
+  def start_batch(self, batch):
+    """Validates a batch of (row number, row) pairs and starts writing it."""
+    pending = []
+    keys = []
+    for number, row in batch:
+      try:
+        key = self.get_key(row)
+        form_class = self.get_form_class(row)
+        data = form_data(row, form_class)
+      except ValueError as e:
+        self.add_error(number, unicode(e))
+        continue
+      pending.append((number, key, form_class, data))
+      if key is not None:
+        keys.append(key)
+      keys.extend(referenced_keys(data, form_class))
+    # The entities to update and the referenced ones, which KeyField.to_python
+    # checks, in a single get.
+    prefetch.prefetch(keys)
+    entities = []
+    for number, key, form_class, data in pending:
+      instance = prefetch.get_prefetched(key) if key is not None else None
+      if key is not None and self.model._meta.sharded_count:
+        # The batch get also tells the counter whether the put inserts.
+        self._bulk.existing[key] = instance is not None
+      if instance is None:
+        instance = self.model(key=key)
+      form = form_class(data, instance=instance)
+      if form.is_valid():
+        entity = form.save(commit=False)
+        missing = self.missing_fields(entity)
+        if missing:
+          self.add_error(number, '; '.join(
+              '%s: %s' % (field.name, forms.Field.default_error_messages['required'])
+              for field in missing))
+        else:
+          entities.append(entity)
+      else:
+        self.add_error(number, '; '.join(
+            '%s: %s' % (name, ' '.join(errors)) for name, errors in form.errors.items()))
+    prefetch.clear()
+    if len(self._in_flight) >= self.max_in_flight:
+      self.finish_oldest_batch()
+    self._in_flight.append((ndb.put_multi_async(entities), batch[-1][0]))
+
+  def finish_oldest_batch(self):
+    futures, last_number = self._in_flight.popleft()
+    for future in futures:
+      future.get_result()
+    self._bulk.flush()
+    self.imported += len(futures)
+    self.checkpoint = last_number
+    if self.on_checkpoint is not None:
+      self.on_checkpoint(self)
+
+
+class ImportForm(forms.Form):
+  file = forms.FileField(label=_('File'))
+  format = forms.ChoiceField(
+      label=_('Format'), required=False,
+      choices=[('', _('From the file name'))] + [(fmt, fmt.upper()) for fmt in export.FORMATS])
+
+  def clean(self):
+    cleaned_data = super(ImportForm, self).clean()
+    upload = cleaned_data.get('file')
+    if upload is not None and not cleaned_data.get('format'):
+      cleaned_data['format'] = guess_format(upload.name)
+      if cleaned_data['format'] is None:
+        raise forms.ValidationError(_('Choose the format of the file.'))
+    return cleaned_data
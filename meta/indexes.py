@@ -0,0 +1,223 @@
+"""Works out the composite indexes the admin's queries need.
+
+Each changelist query is described by a QueryShape: the properties it filters
+on for equality and with ranges, its sort orders and the properties it
+projects onto. index_for() turns a shape into the index serving it,
+following the datastore's rules for which queries the built-in single
+property indexes can answer.
+"""
+import collections
+import itertools
+
+from django.contrib import admin
+from django.core.exceptions import FieldDoesNotExist
+from google.appengine.datastore import datastore_index
+from google.appengine.ext import ndb
+
+from meta.admin import DateFieldListFilter, project_columns
+from meta import search
+from meta.models import KeyPropertyWrapper
+
+KEY = '__key__'
+
+
+class QueryShape(collections.namedtuple(
+    'QueryShape', 'kind equalities inequalities orders projection description')):
+  """A query as the datastore plans it.
+
+  `equalities`, `inequalities` and `projection` are tuples of property names
+  and `orders` a tuple of (name, descending) pairs.
+  """
+
+
+class Index(collections.namedtuple('Index', 'kind properties')):
+  """A composite index; `properties` is a tuple of (name, descending) pairs."""
+  def __str__(self):
+    return '%s(%s)' % (self.kind, ', '.join(
+        name + (' desc' if descending else '') for name, descending in self.properties))
+
+  def to_yaml(self):
+    lines = ['- kind: %s' % self.kind, '  properties:']
+    for name, descending in self.properties:
+      lines.append('  - name: %s' % name)
+      if descending:
+        lines.append('    direction: desc')
+    return '\n'.join(lines)
+
+
+class UnservableQuery(Exception):
+  """Raised for a query that no index can serve."""
+
+
+def index_for(shape, model):
+  """Returns the Index serving `shape`, or None if the built-in indexes do.
+
+  Raises UnservableQuery if the datastore would reject the query.
+  """
+  for name in shape.equalities + shape.inequalities + tuple(n for n, d in shape.orders):
+    prop = model._properties.get(name)
+    if prop is not None and not prop._indexed:
+      raise UnservableQuery('%s is not indexed' % name)
+  inequalities = sorted(set(shape.inequalities))
+  if len(inequalities) > 1:
+    raise UnservableQuery(
+        'it filters on %s with ranges' % ' and '.join(inequalities))
+  # Sorting on a property filtered for equality has no effect.
+  orders = [(name, desc) for name, desc in shape.orders if name not in shape.equalities]
+  if inequalities:
+    if not orders:
+      orders = [(inequalities[0], False)]
+    elif orders[0][0] != inequalities[0]:
+      raise UnservableQuery(
+          'it filters on %s with a range but sorts on %s first'
+          % (inequalities[0], orders[0][0]))
+  if orders and orders[-1] == (KEY, False):
+    # Every index ends with the key in ascending order.
+    orders.pop()
+  ordered = set(shape.equalities) | set(name for name, desc in orders)
+  properties = ([(name, False) for name in sorted(shape.equalities)] + orders +
+                [(name, False) for name in shape.projection if name not in ordered])
+  if len(properties) == len(shape.equalities) and not shape.projection:
+    # Equality filters alone are answered by merging the built-in indexes.
+    return None
+  if len(properties) == 1:
+    return None
+  repeated = [name for name, desc in properties
+              if name in model._properties and model._properties[name]._repeated]
+  if len(repeated) > 1:
+    raise UnservableQuery(
+        'an index on the repeated properties %s would explode' % ', '.join(repeated))
+  return Index(shape.kind, tuple(properties))
+
+
+def _filter_kinds(model_admin):
+  """Yields (property name, is_range) for each list_filter of `model_admin`."""
+  opts = model_admin.model._meta
+  for list_filter in model_admin.list_filter:
+    if isinstance(list_filter, (tuple, list)):
+      field_path, filter_class = list_filter
+    elif isinstance(list_filter, basestring):
+      field_path, filter_class = list_filter, None
+    else:
+      # A SimpleListFilter filters the query however it likes.
+      continue
+    field = opts.get_field(field_path)
+    if filter_class is None:
+      for test, filter_class in admin.filters.FieldListFilter._field_list_filters:
+        if test(field):
+          break
+    yield field.property._name, issubclass(filter_class, DateFieldListFilter)
+
+
+def _sortable_columns(model_admin):
+  """Yields the property names the changelist's column headers sort on."""
+  model = model_admin.model
+  for name in model_admin.list_display:
+    try:
+      order_field = model._meta.get_field(name).name
+    except FieldDoesNotExist:
+      if callable(name):
+        attr = name
+      elif hasattr(model_admin, name):
+        attr = getattr(model_admin, name)
+      else:
+        attr = getattr(model, name, None)
+      order_field = getattr(attr, 'admin_order_field', None)
+    if order_field and order_field.lstrip('-') in model._properties:
+      yield order_field
+
+
+def _orderings(model_admin):
+  """Yields (description, orders) for each ordering the changelist can use."""
+  model = model_admin.model
+  default = [name for name in (model_admin.ordering or model._meta.ordering or ())
+             if name.lstrip('-') in model._properties]
+  yield 'the default ordering', [(name.lstrip('-'), name.startswith('-')) for name in default]
+  for order_field in _sortable_columns(model_admin):
+    name = order_field.lstrip('-')
+    for descending in (False, True):
+      yield ('%s %s' % (name, 'descending' if descending else 'ascending'),
+             [(name, descending)])
+
+
+def changelist_shapes(model_admin):
+  """Yields the QueryShape of every query the changelist of `model_admin` runs.
+
+  Covers each combination of list filters, search and date hierarchy with the
+  default ordering and with a sort on each column, the counts, the date
+  hierarchy's own queries, and with cursor_pagination the queries which page
+  backwards. Sorting on several columns at once isn't covered.
+  """
+  model = model_admin.model
+  kind = model._get_kind()
+  filters = list(_filter_kinds(model_admin))
+  if model_admin.search_fields or model._meta.search_fields:
+    # However many terms there are, they all filter on the one property.
+    filters.append((search.SEARCH_PROPERTY, False))
+  if model_admin.date_hierarchy:
+    filters.append((model._properties[model_admin.date_hierarchy]._name, True))
+  list_display = ['action_checkbox'] + list(model_admin.list_display)
+  for size in range(len(filters) + 1):
+    for used in itertools.combinations(filters, size):
+      equalities = tuple(name for name, is_range in used if not is_range)
+      inequalities = tuple(name for name, is_range in used if is_range)
+      filtered = ' and '.join(name for name, is_range in used) or 'nothing'
+      yield QueryShape(kind, equalities, inequalities, (), (),
+                       'count filtered on %s' % filtered)
+      if model_admin.date_hierarchy and not inequalities:
+        date_name = model._properties[model_admin.date_hierarchy]._name
+        for descending in (False, True):
+          # The first value skips the entities without one.
+          yield QueryShape(kind, equalities, () if descending else (date_name,),
+                           ((date_name, descending),), (date_name,),
+                           'date hierarchy bounds filtered on %s' % filtered)
+      projection = None
+      if (model_admin.list_projection and not model_admin.list_editable and
+          not model_admin.changelist_cache_time):
+        projection = project_columns(model._meta, list_display, equalities)
+      projection = tuple(prop._name for prop in projection or ())
+      for ordered, orders in _orderings(model_admin):
+        description = 'filtered on %s, sorted by %s' % (filtered, ordered)
+        if len(set(inequalities)) == 1 and orders[:1] != [(inequalities[0], False)]:
+          # As NdbChangeList.get_ordering_fields does.
+          orders = [(inequalities[0], False)] + [
+              (name, desc) for name, desc in orders if name != inequalities[0]]
+        if model_admin.cursor_pagination:
+          orders = orders + [(KEY, False)]
+          yield QueryShape(kind, equalities, inequalities,
+                           tuple((name, not desc) for name, desc in orders),
+                           projection, description + ', paging backwards')
+        yield QueryShape(kind, equalities, inequalities, tuple(orders), projection,
+                         description)
+
+
+def choices_shapes(model):
+  """Yields the QueryShapes of the choice lists for the KeyProperties of `model`."""
+  for field in model._meta.local_fields:
+    if not isinstance(field, KeyPropertyWrapper) or not field.property._kind:
+      continue
+    target = ndb.Model._kind_map.get(field.property._kind)
+    label_fields = getattr(getattr(target, '_meta', None), 'label_fields', None)
+    if label_fields:
+      yield QueryShape(field.property._kind, (), (), (), tuple(label_fields),
+                       'choices for %s.%s' % (model._get_kind(), field.name))
+
+
+def site_shapes(site):
+  """Yields (model, QueryShape) for the queries of every admin registered on `site`."""
+  for model, model_admin in site._registry.items():
+    for shape in changelist_shapes(model_admin):
+      yield model, shape
+    for shape in choices_shapes(model):
+      yield ndb.Model._kind_map.get(shape.kind, model), shape
+
+
+def load_indexes(path):
+  """Returns the composite Indexes defined in the index.yaml at `path`."""
+  with open(path) as f:
+    definitions = datastore_index.ParseIndexDefinitions(f)
+  indexes = []
+  for index in (definitions and definitions.indexes) or ():
+    indexes.append(Index(index.kind, tuple(
+        (p.name, p.direction == 'desc') for p in index.properties or ())))
+  return indexes
@@ -0,0 +1,94 @@
+import datetime
+import json
+import subprocess
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import autodiscover_modules
+
+from meta import benchmarks
+
+
+class Command(BaseCommand):
+  help = "Runs the benchmark scenarios in meta.benchmarks."
+
+  def add_arguments(self, parser):
+    parser.add_argument('scenarios', nargs='*',
+                        help='Scenarios to run; all of them by default.')
+    parser.add_argument('--models', type=int, default=200,
+                        help='Number of models defined by the startup scenarios.')
+    parser.add_argument('--properties', type=int, default=20,
+                        help='Number of properties on each of those models.')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Simulated round trip time of each RPC, in ms.')
+    parser.add_argument('--authors', type=int, default=100,
+                        help='Number of Authors to seed.')
+    parser.add_argument('--books', type=int, default=1000,
+                        help='Number of Books (and Reviews) to seed.')
+    parser.add_argument('--libraries', type=int, default=100,
+                        help='Number of Libraries to seed.')
+    parser.add_argument('--body-size', type=int, default=100 * 1024,
+                        help='Size in bytes of the body of each Review.')
+    parser.add_argument('--selected', type=int, default=100,
+                        help='Number of Books selected for delete_selected.')
+    parser.add_argument('--requests', type=int, default=100,
+                        help='Number of requests for the middleware scenario.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Runs of each scenario; the median run is reported.')
+    parser.add_argument('--output',
+                        help='File to save the results to, as JSON.')
+    parser.add_argument('--compare',
+                        help='Results saved by an earlier run to compare with.')
+
+  def handle(self, *args, **options):
+    autodiscover_modules('benchmarks')
+    names = options['scenarios'] or list(benchmarks.SCENARIOS)
+    for name in names:
+      if name not in benchmarks.SCENARIOS:
+        raise CommandError('Unknown scenario %r.' % name)
+    previous = {}
+    if options['compare']:
+      with open(options['compare']) as f:
+        previous = json.load(f)['results']
+
+    results = {}
+    self.stdout.write('%-30s %10s %6s %12s %10s' % (
+        'scenario', 'wall ms', 'rpcs', 'peak KB', 'run KB'))
+    for name in names:
+      try:
+        runs = [benchmarks.run_isolated(name, options) for i in range(options['repeat'])]
+      except benchmarks.BenchmarkError as e:
+        raise CommandError(str(e))
+      runs.sort(key=lambda result: result['wall_ms'])
+      result = results[name] = runs[len(runs) // 2]
+      # What the timed run added to the peak, beyond the scenario's setup.
+      run_memory = (result['peak_memory_kb'] - result['setup_peak_memory_kb']
+                    if result['peak_memory_kb'] is not None else None)
+      line = '%-30s %10.1f %6d %12s %10s' % (
+          name, result['wall_ms'], result['rpcs'].get('total', 0),
+          result['peak_memory_kb'] or '-', '-' if run_memory is None else run_memory)
+      if name in previous:
+        before = previous[name]
+        line += '   %+.0f%% wall, %+d rpcs' % (
+            (result['wall_ms'] / before['wall_ms'] - 1) * 100 if before['wall_ms'] else 0,
+            result['rpcs'].get('total', 0) - before['rpcs'].get('total', 0))
+      self.stdout.write(line)
+
+    if options['output']:
+      report = {
+          'commit': self.get_commit(),
+          'date': datetime.datetime.utcnow().isoformat(),
+          'options': dict((key, options[key]) for key in (
+              'models', 'properties', 'latency', 'authors', 'books', 'libraries',
+              'body_size', 'selected', 'requests', 'repeat')),
+          'results': results,
+      }
+      with open(options['output'], 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+  def get_commit(self):
+    try:
+      return subprocess.check_output(
+          ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+      return None
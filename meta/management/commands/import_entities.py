@@ -0,0 +1,88 @@
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from google.appengine.ext import ndb
+
+from meta import export
+from meta import importer
+from meta.models import DjangoCompatibleModel
+
+
+class Command(BaseCommand):
+  help = ("Imports a CSV or JSON lines file, as the admin exports them, into a "
+          "kind, validating each row with the model's form and writing them in "
+          "batches.")
+
+  def add_arguments(self, parser):
+    parser.add_argument('kind')
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=list(export.FORMATS),
+                        help='The format of the file; by default, its extension.')
+    parser.add_argument('--batch-size', type=int, default=importer.IMPORT_BATCH_SIZE)
+    parser.add_argument('--in-flight', type=int, default=importer.MAX_BATCHES_IN_FLIGHT,
+                        help='How many batches are written at once.')
+    parser.add_argument('--checkpoint',
+                        help='A file recording how many rows have been imported.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip the rows which the checkpoint file records.')
+    parser.add_argument('--progress-interval', type=float, default=10,
+                        help='Seconds between progress reports.')
+
+  def handle(self, *args, **options):
+    model = ndb.Model._kind_map.get(options['kind'])
+    if model is None or not issubclass(model, DjangoCompatibleModel):
+      raise CommandError('%s is not a DjangoCompatibleModel kind.' % options['kind'])
+    path = options['path']
+    fmt = options['format'] or importer.guess_format(path)
+    if fmt is None:
+      raise CommandError('Pass --format, as %s has no known extension.' % path)
+    checkpoint_path = options['checkpoint']
+    skip = 0
+    if options['resume']:
+      if not checkpoint_path:
+        raise CommandError('--resume needs a --checkpoint file.')
+      if os.path.exists(checkpoint_path):
+        skip = self.read_checkpoint(checkpoint_path, options['kind'], path)
+
+    self.last_report = time.time()
+
+    def on_checkpoint(imp):
+      if checkpoint_path:
+        self.write_checkpoint(checkpoint_path, options['kind'], path, imp)
+      if time.time() - self.last_report >= options['progress_interval']:
+        self.last_report = time.time()
+        self.stdout.write('%d rows done, %d entities imported, %.0f entities/s.'
+                          % (imp.checkpoint, imp.imported, imp.rate))
+
+    imp = importer.Importer(model, options['batch_size'], options['in_flight'],
+                            on_checkpoint)
+    if skip:
+      self.stdout.write('Resuming after row %d.' % skip)
+    with open(path, 'rb') as f:
+      imp.import_rows(importer.read_rows(f, fmt), skip)
+
+    self.stdout.write('Imported %d %s entities in %.1fs, %.0f entities/s.' % (
+        imp.imported, options['kind'], time.time() - imp.started, imp.rate))
+    if imp.error_count:
+      self.stdout.write('%d rows had errors:' % imp.error_count)
+      for number, message in imp.errors:
+        self.stdout.write('  row %d: %s' % (number, message))
+      if imp.error_count > len(imp.errors):
+        self.stdout.write('  and %d more' % (imp.error_count - len(imp.errors)))
+
+  def read_checkpoint(self, checkpoint_path, kind, path):
+    with open(checkpoint_path) as f:
+      checkpoint = json.load(f)
+    if checkpoint['kind'] != kind or checkpoint['path'] != os.path.abspath(path):
+      raise CommandError('%s records an import of %s into %s.' % (
+          checkpoint_path, checkpoint['path'], checkpoint['kind']))
+    return checkpoint['rows']
+
+  def write_checkpoint(self, checkpoint_path, kind, path, imp):
+    # Written aside and renamed, so an interruption leaves the previous one.
+    with open(checkpoint_path + '.tmp', 'w') as f:
+      json.dump({'kind': kind, 'path': os.path.abspath(path),
+                 'rows': imp.checkpoint, 'imported': imp.imported}, f)
+    os.rename(checkpoint_path + '.tmp', checkpoint_path)
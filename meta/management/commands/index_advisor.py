@@ -0,0 +1,88 @@
+import collections
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import autodiscover_modules
+
+from meta import indexes
+from meta.admin import site
+
+HEADER = """indexes:
+
+# The indexes above the marker serve the admin; they are written by
+# `manage.py index_advisor --write`, which keeps those of other kinds.
+
+"""
+
+MARKER = """
+# AUTOGENERATED
+
+# This index.yaml is automatically updated whenever the dev_appserver
+# detects that a new type of query is run.  If you want to manage the
+# index.yaml file manually, remove the above marker line (the line
+# saying "# AUTOGENERATED").  If you want to manage some indexes
+# manually, move them above the marker line.  The index.yaml file is
+# automatically uploaded to the admin console when you next deploy
+# your application using appcfg.py.
+"""
+
+
+class Command(BaseCommand):
+  help = ("Lists the composite indexes the registered admins' queries need, "
+          "and the queries no index can serve.")
+
+  def add_arguments(self, parser):
+    parser.add_argument('--index-file', default=os.path.join(settings.BASE_DIR, 'index.yaml'),
+                        help='The index.yaml to compare with, and to write.')
+    parser.add_argument('--write', action='store_true',
+                        help='Rewrite the index file with the indexes needed.')
+    parser.add_argument('--verbose-shapes', action='store_true',
+                        help='Also list the queries each index serves.')
+
+  def handle(self, *args, **options):
+    autodiscover_modules('admin')
+    needed = collections.OrderedDict()
+    unservable = []
+    for model, shape in indexes.site_shapes(site):
+      try:
+        index = indexes.index_for(shape, model)
+      except indexes.UnservableQuery as e:
+        unservable.append((shape, e))
+        continue
+      if index is not None:
+        needed.setdefault(index, []).append(shape)
+
+    path = options['index_file']
+    existing = indexes.load_indexes(path) if os.path.exists(path) else []
+    admin_kinds = set(model._get_kind() for model in site._registry)
+    admin_kinds.update(shape.kind for shapes in needed.values() for shape in shapes)
+
+    self.stdout.write('Indexes needed by the admin (%d):' % len(needed))
+    for index, shapes in needed.items():
+      missing = '' if index in existing else '  (missing)'
+      self.stdout.write('  %s%s' % (index, missing))
+      if options['verbose_shapes']:
+        for shape in shapes:
+          self.stdout.write('      %s' % shape.description)
+
+    if unservable:
+      self.stdout.write('Queries no index can serve (%d):' % len(unservable))
+      for shape, e in unservable:
+        self.stdout.write('  %s %s: %s' % (shape.kind, shape.description, e))
+
+    # Every index is updated on each write of its kind, used or not.
+    unused = [index for index in existing
+              if index.kind in admin_kinds and index not in needed]
+    if unused:
+      self.stdout.write('Indexes of admin kinds which the admin does not use (%d):' % len(unused))
+      for index in unused:
+        self.stdout.write('  %s' % (index,))
+
+    if options['write']:
+      others = [index for index in existing if index.kind not in admin_kinds]
+      with open(path, 'w') as f:
+        f.write(HEADER)
+        f.write('\n\n'.join(index.to_yaml() for index in list(needed) + others))
+        f.write('\n' + MARKER)
+      self.stdout.write('Wrote %d indexes to %s.' % (len(needed) + len(others), path))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from google.appengine.ext import ndb
+
+from meta.models import User
+
+
+class Command(BaseCommand):
+  help = "Moves Users stored under automatic ids to keys named by their user_id."
+
+  def add_arguments(self, parser):
+    parser.add_argument('--batch-size', type=int, default=100)
+
+  def handle(self, *args, **options):
+    batch_size = options['batch_size']
+    migrated = 0
+    cursor = None
+    more = True
+    while more:
+      users, cursor, more = User.query().fetch_page(batch_size, start_cursor=cursor)
+      legacy = [u for u in users if not isinstance(u.key.id(), basestring) and u.user_id]
+      if not legacy:
+        continue
+      futures = [User.get_or_insert_async(u.user_id, **u.to_dict()) for u in legacy]
+      for future in futures:
+        future.get_result()
+      ndb.delete_multi([u.key for u in legacy])
+      migrated += len(legacy)
+    self.stdout.write('Migrated %d users.' % migrated)
@@ -0,0 +1,54 @@
+import contextlib
+
+from django.core.management.base import BaseCommand, CommandError
+from google.appengine.ext import ndb
+
+from meta import models
+
+
+@contextlib.contextmanager
+def auto_now_disabled(model):
+  """Keeps the auto_now properties of `model` as they are while rewriting it.
+
+  Only the tokens change, so timestamps such as the one a listing's
+  Last-Modified follows should too.
+  """
+  props = [prop for prop in model._properties.values()
+           if getattr(prop, '_auto_now', False)]
+  for prop in props:
+    prop._auto_now = False
+  try:
+    yield
+  finally:
+    for prop in props:
+      prop._auto_now = True
+
+
+class Command(BaseCommand):
+  help = ("Rewrites the entities of a kind so that their search tokens match "
+          "its Meta.search_fields, as after adding or changing them.")
+
+  def add_arguments(self, parser):
+    parser.add_argument('kind')
+    parser.add_argument('--batch-size', type=int, default=100)
+
+  def handle(self, *args, **options):
+    model = ndb.Model._kind_map.get(options['kind'])
+    if not getattr(getattr(model, '_meta', None), 'search_fields', None):
+      raise CommandError('%s is not a kind with search_fields.' % options['kind'])
+    updated = 0
+    cursor = None
+    more = True
+    with auto_now_disabled(model), models.bulk_writes() as bulk:
+      while more:
+        # Kept out of the context cache, which would otherwise hold the kind.
+        entities, cursor, more = model.query().fetch_page(
+            options['batch_size'], start_cursor=cursor, use_cache=False)
+        # Rewrites, so the counter has nothing to look up.
+        bulk.existing.update((entity.key, True) for entity in entities)
+        # The put hook recomputes the tokens.
+        ndb.put_multi(entities, use_cache=False)
+        bulk.existing.clear()
+        bulk.flush()
+        updated += len(entities)
+    self.stdout.write('Updated %d entities.' % updated)
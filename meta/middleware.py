@@ -1,16 +1,107 @@
+import cProfile
+import datetime
+import logging
+import os
+import re
+
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils.encoding import force_text
 from google.appengine.api import users
-from google.appengine.ext import ndb
+
+from meta import cache
+from meta import rpcstats
 from meta.models import User
 
+PROFILE_VAR = 'profile'
+
+
 class GaeAuthenticationMiddleware(object):
   def process_request(self, request):
     user = users.get_current_user()
     if not user:
         return
-    q = User.query(User.user_id==user.user_id())
-    user_instance = q.get()
-    if not user_instance:
-      user_instance = User(user_id=user.user_id(), username=user.nickname(),
-                           email=user.email())
-      user_instance.put()
-    request.user = user_instance
+    request.user = User.get_for_user_async(user).get_result()
+
+
+def _is_staff(request):
+  return getattr(getattr(request, 'user', None), 'is_staff', False)
+
+
+class RpcStatsMiddleware(object):
+  """Reports the RPCs each request made; see meta.rpcstats.
+
+  A summary is logged, and for staff users sent in the X-Rpc-* response
+  headers. Two settings turn on more for staff users: META_RPC_DEBUG_PANEL
+  adds a table of the RPCs by method and by call site, and the hit rates of
+  meta.cache's caches, to HTML pages, and META_PROFILE_DIR lets a `?profile`
+  parameter run the view under cProfile and save the stats in that
+  directory, for pstats or a viewer. Put it first in MIDDLEWARE_CLASSES, so
+  that it sees the RPCs of the other middleware too.
+  """
+  def process_request(self, request):
+    request.rpc_stats = rpcstats.start()
+    request.profiler = None
+
+  def process_view(self, request, view_func, view_args, view_kwargs):
+    # The user is only known once the other middleware has processed the
+    # request, so the profile starts with the view.
+    if (PROFILE_VAR in request.GET and getattr(settings, 'META_PROFILE_DIR', None) and
+        _is_staff(request)):
+      request.profiler = cProfile.Profile()
+      request.profiler.enable()
+
+  def process_response(self, request, response):
+    stats = rpcstats.stop()
+    if stats is None or getattr(request, 'rpc_stats', None) is not stats:
+      return response
+    profiler = request.profiler
+    if profiler is not None:
+      profiler.disable()
+    summary = stats.summary()
+    count = len(stats.rpcs)
+    logging.info('%d RPCs, %.0f ms: %s', count, stats.total_ms, ', '.join(
+        '%s x%d (%d items, %.0f ms)' % (name, n, items, ms)
+        for name, (n, items, ms) in summary.items()))
+    if not _is_staff(request):
+      return response
+    response['X-Rpc-Count'] = str(count)
+    response['X-Rpc-Ms'] = '%.0f' % stats.total_ms
+    response['X-Rpc-Summary'] = ';'.join(
+        '%s=%d/%d' % (name, n, items) for name, (n, items, ms) in summary.items())
+
+    if profiler is not None:
+      self.save_profile(request, profiler)
+    if (getattr(settings, 'META_RPC_DEBUG_PANEL', False) and
+        'html' in response.get('Content-Type', '') and not response.streaming):
+      self.add_debug_panel(request, response, stats)
+    return response
+
+  def save_profile(self, request, profiler):
+    name = '%s-%s.pstats' % (
+        datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f'),
+        re.sub(r'[^\w]+', '-', request.path).strip('-') or 'root')
+    path = os.path.join(settings.META_PROFILE_DIR, name)
+    try:
+      profiler.dump_stats(path)
+    except (IOError, OSError):
+      logging.exception('Could not save the profile of %s', request.path)
+    else:
+      logging.info('Saved the profile of %s to %s', request.path, path)
+
+  def add_debug_panel(self, request, response, stats):
+    content = force_text(response.content, encoding=response.charset)
+    end = content.lower().rfind('</body>')
+    if end == -1:
+      return
+    panel = render_to_string('admin/rpc_debug_panel.html', {
+        'stats': stats,
+        'summary': [(name, n, items, ms) for name, (n, items, ms) in stats.summary().items()],
+        'call_sites': stats.call_sites(),
+        'cache_stats': [
+            (prefix, hits, misses, 100.0 * hits / (hits + misses) if hits + misses else None)
+            for prefix, (hits, misses) in cache.get_stats().items()],
+    })
+    response.content = content[:end] + panel + content[end:]
+    if response.has_header('Content-Length'):
+      response['Content-Length'] = str(len(response.content))
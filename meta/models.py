@@ -1,3 +1,8 @@
+import collections
+import contextlib
+import functools
+import threading
+
 from django.apps import apps
 from django.db.models import options
 from django.db.models.base import ModelState
@@ -5,13 +10,20 @@ from django.db.models.fields import BLANK_CHOICE_DASH, NOT_PROVIDED
 from django.db.models.fields.related import ManyToOneRel
 from django.db.models.query_utils import PathInfo
 from django import forms
-from django.utils.encoding import smart_text, force_text
+from django.template.defaultfilters import filesizeformat
+from django.utils.encoding import force_text
 from django.utils.functional import cached_property
 from django.utils.text import capfirst
+from django.utils.translation import ugettext as _, ungettext
 
 from google.appengine.ext import ndb
 
-from meta.forms import KeyField, MultipleKeyField
+from meta import cache
+from meta import counters
+from meta.forms import BlobField, JsonField, KeyField, MultipleKeyField, StructuredField, get_key_choices
+from meta import prefetch
+from meta import search
+from meta.prefetch import get_prefetched, get_prefetched_multi
 
 class PropertyWrapper(object):
   one_to_many = False
@@ -22,6 +34,7 @@ class PropertyWrapper(object):
   concrete = True
   editable = True
   unique = False
+  primary_key = False
   auto_created = False
   formfield_class = forms.CharField
 
@@ -68,7 +81,10 @@ class PropertyWrapper(object):
 
   def display_value(self, value):
     if isinstance(self.property, ndb.KeyProperty):
-      return value.get() if value else ""
+      if self.property._repeated:
+        return ', '.join(force_text(obj) for obj in get_prefetched_multi(value or [])
+                         if obj is not None)
+      return get_prefetched(value) if value else ""
     return value
 
   def save_form_data(self, instance, data):
@@ -140,10 +156,7 @@ class KeyPropertyWrapper(PropertyWrapper):
     initially for utilization by RelatedFieldListFilter.
     """
     first_choice = blank_choice if include_blank else []
-    queryset = ndb.Query(kind=self.property._kind)
-
-    lst = [(x.key.urlsafe(), smart_text(x)) for x in queryset]
-    return first_choice + lst
+    return first_choice + get_key_choices(ndb.Query(kind=self.property._kind))
 
 class StringPropertyWrapper(PropertyWrapper):
   pass
@@ -177,7 +190,73 @@ class TextPropertyWrapper(PropertyWrapper):
       'widget': forms.Textarea
     }
     defaults.update(kwargs)
-    super(KeyPropertyWrapper, self).formfield(**defaults)
+    return super(TextPropertyWrapper, self).formfield(**defaults)
+
+# Payloads up to this many bytes are decoded for the changelist summary, to
+# list their keys; larger ones are only summarized by their size.
+SUMMARY_DECODE_LIMIT = 4 * 1024
+SUMMARY_KEYS = 5
+
+class LargePropertyWrapper(PropertyWrapper):
+  """For properties whose values are stored compressed or serialized.
+
+  ndb only decodes such a value when the property is read, and summary()
+  describes it from the stored bytes instead, so that a changelist of large
+  payloads doesn't decode them all; NdbAdmin shows these columns with it.
+  """
+  def summary(self, obj):
+    values = obj._values.get(self.property._name)
+    if values is None:
+      return ''
+    if not isinstance(values, list):
+      values = [values]
+    return '; '.join(self.summarize(value) for value in values)
+
+  def summarize(self, value):
+    if isinstance(value, ndb.model._BaseValue):
+      stored = value.b_val
+      if isinstance(stored, ndb.model._CompressedValue):
+        return _('%s compressed') % filesizeformat(len(stored.z_val))
+      if isinstance(stored, basestring) and len(stored) > SUMMARY_DECODE_LIMIT:
+        return filesizeformat(len(stored))
+      value = self.property._opt_call_from_base_type(value)
+    return self.describe(value)
+
+  def describe(self, value):
+    """Describes a decoded value: the keys of an object, or its length."""
+    if isinstance(value, ndb.Model):
+      value = value.to_dict()
+    if isinstance(value, dict):
+      keys = sorted(force_text(key) for key in value)
+      if len(keys) > SUMMARY_KEYS:
+        keys = keys[:SUMMARY_KEYS] + [u'\u2026']
+      return u'{%s}' % ', '.join(keys)
+    if isinstance(value, (list, tuple)):
+      return ungettext('%d item', '%d items', len(value)) % len(value)
+    if isinstance(value, basestring):
+      return filesizeformat(len(value))
+    return force_text(value)
+
+class BlobPropertyWrapper(LargePropertyWrapper):
+  formfield_class = BlobField
+
+class JsonPropertyWrapper(LargePropertyWrapper):
+  formfield_class = JsonField
+
+class PicklePropertyWrapper(LargePropertyWrapper):
+  # Unpickling what a form submitted would run whatever code it names.
+  editable = False
+
+class StructuredPropertyWrapper(LargePropertyWrapper):
+  formfield_class = StructuredField
+
+  def formfield(self, **kwargs):
+    defaults = {
+      'modelclass': self.property._modelclass,
+      'repeated': self.property._repeated,
+    }
+    defaults.update(kwargs)
+    return super(StructuredPropertyWrapper, self).formfield(**defaults)
 
 WRAPPERS = {
   ndb.IntegerProperty: IntegerPropertyWrapper,
@@ -187,6 +266,11 @@ WRAPPERS = {
   ndb.DateTimeProperty: DateTimePropertyWrapper,
   ndb.TextProperty: TextPropertyWrapper,
   ndb.KeyProperty: KeyPropertyWrapper,
+  ndb.BlobProperty: BlobPropertyWrapper,
+  ndb.JsonProperty: JsonPropertyWrapper,
+  ndb.PickleProperty: PicklePropertyWrapper,
+  ndb.StructuredProperty: StructuredPropertyWrapper,
+  ndb.LocalStructuredProperty: StructuredPropertyWrapper,
 }
 
 class KeyWrapper(PropertyWrapper):
@@ -214,17 +298,68 @@ class InnerMeta:
   pass
 
 
+NDB_META_OPTIONS = (
+  # The order of the fields in forms; see NdbMeta.setup_fields.
+  'field_order',
+  # The properties that __unicode__ reads, so that labels can be loaded with
+  # a projection query instead of fetching whole entities.
+  'label_fields',
+  # Whether to keep a sharded counter of the number of entities; see
+  # meta.counters.
+  'sharded_count',
+  # The properties whose words the admin can search for; see meta.search.
+  'search_fields',
+)
+
+
 class NdbMeta(options.Options):
+  """Options for an ndb model, whose field wrappers are built on first use.
+
+  Building a wrapper for every property of every model at import time is a
+  large part of the cost of a loading request, and it can only resolve the
+  kinds of KeyProperties whose models have already been imported. So the
+  model's fields are only created the first time anything reads them, by which
+  time all the models are in ndb's kind map.
+  """
+  # Instances whose fields have not been built yet.
+  pending = []
+
+  def __init__(self, *args, **kwargs):
+    self._fields_ready = False
+    super(NdbMeta, self).__init__(*args, **kwargs)
+
   @classmethod
   def associate_to_model(cls, model, app_label):
     inner_meta = getattr(model, 'Meta', InnerMeta)
-    field_order = getattr(inner_meta, 'field_order', None)
-    if field_order is not None:
-      delattr(inner_meta, 'field_order')
+    # Django's Options rejects Meta attributes it doesn't know, so take ours
+    # out first.
+    ndb_options = {}
+    for name in NDB_META_OPTIONS:
+      ndb_options[name] = getattr(inner_meta, name, None)
+      if name in vars(inner_meta):
+        delattr(inner_meta, name)
 
     instance = cls(inner_meta, app_label)
+    instance.__dict__.update(ndb_options)
     instance.contribute_to_class(model, None)
-    instance.add_field(KeyWrapper(instance.model.key))
+    cls.pending.append(instance)
+
+  @classmethod
+  def setup_all(cls):
+    """Builds the fields of every model that has not been used yet.
+
+    Useful in a warmup request, to take the work off the first user request.
+    """
+    while cls.pending:
+      cls.pending.pop().setup_fields()
+
+  def setup_fields(self):
+    if self._fields_ready:
+      return
+    self._fields_ready = True
+    if self in self.pending:
+      self.pending.remove(self)
+    self.add_field(KeyWrapper(self.model.key))
 
     # ndb models store their properties in a standard dict, so there is no
     # consistent field order. The Django model metaclass registers fields with a
@@ -234,7 +369,8 @@ class NdbMeta(options.Options):
     # to specify fields in a particular order, which will be used to set the
     # creation_counter. If the field_order attribute is missing, or does not
     # contain all the defined fields, they will be added in sorted order.
-    all_fields = instance.model._properties
+    all_fields = self.model._properties
+    field_order = self.field_order
     if field_order:
       # check we have all the fields listed; if not, just add them on the end.
       missing = set(all_fields).difference(field_order)
@@ -245,14 +381,42 @@ class NdbMeta(options.Options):
     for creation_counter, fieldname in enumerate(field_order):
       field = all_fields[fieldname]
       wrapper_class = WRAPPERS.get(field.__class__, PropertyWrapper)
-      wrapper = wrapper_class(fieldname, field, model, creation_counter)
-      instance.add_field(wrapper)
+      wrapper = wrapper_class(fieldname, field, self.model, creation_counter)
+      if fieldname == search.SEARCH_PROPERTY:
+        # Maintained by the put hook.
+        wrapper.editable = False
+      if getattr(field, '_auto_now', False) or getattr(field, '_auto_now_add', False):
+        # Set by ndb on put, as Django does for its auto_now fields.
+        wrapper.editable = False
+      self.add_field(wrapper)
+
+  # Everything Django derives fields from goes through local_fields or pk, so
+  # reading either is what triggers building the wrappers.
+  @property
+  def local_fields(self):
+    self.setup_fields()
+    return self._local_fields
+
+  @local_fields.setter
+  def local_fields(self, value):
+    self._local_fields = value
+
+  @property
+  def pk(self):
+    self.setup_fields()
+    return self._pk
+
+  @pk.setter
+  def pk(self, value):
+    self._pk = value
 
 
 class NdbModelMeta(ndb.MetaModel):
   def __init__(cls, name, bases, attrs):
     super(NdbModelMeta, cls).__init__(name, bases, attrs)
     NdbMeta.associate_to_model(cls, 'meta')
+    if cls._meta.search_fields:
+      search.add_search_property(cls)
 
 
 class KeyValue(object):
@@ -278,6 +442,120 @@ class KeyValue(object):
       return False
 
 
+class _Local(threading.local):
+  # The bulk_writes() in progress on this thread.
+  bulk = None
+
+  def __init__(self):
+    # Whether the entities being deleted existed, by key, from the pre to the
+    # post delete hook.
+    self.deleting = {}
+
+_local = _Local()
+
+
+def _has_sharded_count(kind):
+  model = ndb.Model._kind_map.get(kind)
+  return bool(getattr(getattr(model, '_meta', None), 'sharded_count', False))
+
+
+class BulkWrites(object):
+  """The bookkeeping of the writes made in bulk_writes(), done by flush()."""
+  def __init__(self):
+    self.kinds = set()
+    self.count_deltas = collections.Counter()
+    # Whether the entities about to be written exist, by key, for the counters
+    # of the writes to come; see check_existing().
+    self.existing = {}
+
+  def check_existing(self, keys):
+    """Finds out which of `keys` exist with one get, for their writes' counts.
+
+    Only the complete keys of models with a sharded count are looked up.
+    """
+    keys = [key for key in set(keys) if key.id() is not None and
+            key not in self.existing and _has_sharded_count(key.kind())]
+    entities = ndb.get_multi(keys, use_memcache=False)
+    for key, entity in zip(keys, entities):
+      self.existing[key] = entity is not None
+
+  def flush(self):
+    """Invalidates the kinds written and updates their counters, once each."""
+    ndb.Future.wait_all([cache.invalidate_async(kind) for kind in self.kinds])
+    for kind, delta in self.count_deltas.items():
+      if delta:
+        counters.increment(kind, delta)
+    self.kinds.clear()
+    self.count_deltas.clear()
+
+
+@contextlib.contextmanager
+def bulk_writes():
+  """Gathers the cache invalidations and counter updates of every write.
+
+  Each put or delete otherwise costs a memcache RPC, and for models with a
+  sharded count a get and a transaction; in bulk they are done by
+  BulkWrites.flush(), which the caller should call after each batch, and which
+  runs on exit. The bulk is per thread rather than per context, as the writes
+  made in transactions have contexts of their own. A nested bulk_writes()
+  joins the enclosing one, which flushes it.
+  """
+  if _local.bulk is not None:
+    yield _local.bulk
+    return
+  bulk = _local.bulk = BulkWrites()
+  try:
+    yield bulk
+  finally:
+    _local.bulk = None
+    bulk.flush()
+
+
+def _exists(key):
+  """Whether the entity of `key` exists, before a write to it."""
+  if key is None or key.id() is None:
+    return False
+  bulk = _local.bulk
+  if bulk is not None and key in bulk.existing:
+    return bulk.existing[key]
+  # In a transaction, the get is part of it.
+  return key.get(use_memcache=False) is not None
+
+
+def _written(key, sharded_count, delta):
+  """Records a write to `key`, adding `delta` to the count of its kind.
+
+  The write of a transaction is only recorded once it commits, as the
+  counters are updated in transactions of their own.
+  """
+  context = ndb.get_context()
+  if context.in_transaction():
+    context.call_on_commit(functools.partial(_record_write, key, sharded_count, delta, True))
+  else:
+    _record_write(key, sharded_count, delta, False)
+
+
+def _record_write(key, sharded_count, delta, committed):
+  kind = key.kind()
+  bulk = _local.bulk
+  if bulk is not None:
+    bulk.kinds.add(kind)
+    if sharded_count:
+      bulk.count_deltas[kind] += delta
+      # The entity's existence has changed since it was looked up.
+      bulk.existing.pop(key, None)
+    return
+  if committed:
+    # The transaction's context, current here, is about to be dropped along
+    # with the invalidations it has pending.
+    cache.invalidate(kind)
+  else:
+    # Not waited for: the request's end flushes it with the context's batches.
+    cache.invalidate_async(kind)
+  if sharded_count and delta:
+    counters.increment(kind, delta)
+
+
 class DjangoCompatibleModel(ndb.Model):
   __metaclass__ = NdbModelMeta
 
@@ -300,6 +578,31 @@ class DjangoCompatibleModel(ndb.Model):
   def delete(self, *args, **kwargs):
     self.key.delete()
 
+  def _pre_put_hook(self):
+    if self._meta.sharded_count:
+      # An allocated id or a name doesn't tell whether the put inserts.
+      self._existed = _exists(self.key)
+    if self._meta.search_fields:
+      search.update_tokens(self)
+
+  def _post_put_hook(self, future):
+    prefetch.forget(self.key)
+    inserted = self._meta.sharded_count and not self._existed and not future.get_exception()
+    _written(self.key, self._meta.sharded_count, 1 if inserted else 0)
+
+  @classmethod
+  def _pre_delete_hook(cls, key):
+    if cls._meta.sharded_count:
+      # Deleting a missing entity changes nothing.
+      _local.deleting[key] = _exists(key)
+
+  @classmethod
+  def _post_delete_hook(cls, key, future):
+    prefetch.forget(key)
+    existed = _local.deleting.pop(key, False)
+    deleted = cls._meta.sharded_count and existed and not future.get_exception()
+    _written(key, cls._meta.sharded_count, -1 if deleted else 0)
+
   def __str__(self):
     if hasattr(self, '__unicode__'):
       return force_text(self).encode('utf-8')
@@ -320,11 +623,60 @@ class DjangoCompatibleModel(ndb.Model):
 
 
 class User(DjangoCompatibleModel):
+  """An App Engine user, keyed by their GAE user_id."""
   user_id = ndb.StringProperty()
   username = ndb.StringProperty()
   email = ndb.StringProperty()
   is_staff = ndb.BooleanProperty(default=False)
 
+  @classmethod
+  @ndb.tasklet
+  def get_for_user_async(cls, user):
+    """Returns the User for a users.User, creating it the first time.
+
+    This is a get by key, so it is normally served from the context cache or
+    memcache. Creation is transactional, so concurrent first requests cannot
+    create duplicates. Users stored before they were keyed by user_id are moved
+    to the new key when they are first seen.
+    """
+    user_id = user.user_id()
+    instance = yield cls.get_by_id_async(user_id)
+    if instance is None:
+      legacy = yield cls.query(cls.user_id == user_id).get_async()
+      if legacy:
+        values = legacy.to_dict()
+      else:
+        values = dict(user_id=user_id, username=user.nickname(),
+                      email=user.email())
+      instance = yield cls.get_or_insert_async(user_id, **values)
+      if legacy:
+        yield legacy.key.delete_async()
+    raise ndb.Return(instance)
 
   def __unicode__(self):
     return self.username
+
+
+class Job(DjangoCompatibleModel):
+  """Progress of work that was handed to the task queue."""
+  description = ndb.StringProperty()
+  total = ndb.IntegerProperty(default=0)
+  done = ndb.IntegerProperty(default=0)
+  finished = ndb.BooleanProperty(default=False)
+  updated = ndb.DateTimeProperty(auto_now=True)
+  # Where to fetch the output of the work, if it has any, once it is finished.
+  download_url = ndb.StringProperty()
+
+  class Meta:
+    field_order = ['description', 'done', 'total', 'finished', 'updated', 'download_url']
+
+  def __unicode__(self):
+    return self.description
+
+
+class ExportPart(ndb.Model):
+  """A piece of the output of an export task, under its Job.
+
+  The ids count up from 1 in the order of the output.
+  """
+  data = ndb.BlobProperty(compressed=True)
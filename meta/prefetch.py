@@ -0,0 +1,42 @@
+from google.appengine.ext import ndb
+
+
+def _prefetched_futures():
+  # Stored on the ndb context, which NdbDjangoMiddleware creates afresh for
+  # each request, so prefetched entities never outlive the request.
+  context = ndb.get_context()
+  futures = getattr(context, '_meta_prefetched', None)
+  if futures is None:
+    futures = context._meta_prefetched = {}
+  return futures
+
+
+def prefetch(keys):
+  """Starts fetching all of `keys` in a single batch, without waiting for it."""
+  futures = _prefetched_futures()
+  keys = [key for key in set(keys) if key not in futures]
+  if keys:
+    futures.update(zip(keys, ndb.get_multi_async(keys)))
+
+
+def get_prefetched(key):
+  """Returns the entity for `key`, from the prefetched batch if it is there."""
+  future = _prefetched_futures().get(key)
+  if future is None:
+    return key.get()
+  return future.get_result()
+
+
+def get_prefetched_multi(keys):
+  prefetch(keys)
+  return [get_prefetched(key) for key in keys]
+
+
+def clear():
+  """Drops every prefetched entity, to keep long running work from hoarding them."""
+  _prefetched_futures().clear()
+
+
+def forget(key):
+  """Drops `key` from the prefetched batch, as it has been written since."""
+  _prefetched_futures().pop(key, None)
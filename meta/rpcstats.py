@@ -0,0 +1,108 @@
+"""Records the RPCs a request makes; see middleware.RpcStatsMiddleware.
+
+Hooks on the apiproxy see every RPC: the datastore and memcache calls ndb
+makes, whether batched, asynchronous or not. For each one they record the
+service and method, how many keys, entities or results it carried, how long it
+took until its result was used, and where in the app it was made. ndb issues
+many RPCs from its event loop, so the call site is the innermost app frame on
+the stack, which is the code that waited for the result.
+"""
+import collections
+import os
+import sys
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+THIS_FILE = os.path.splitext(os.path.abspath(__file__))[0]
+
+# How to count the items carried by an RPC, from its request and response.
+BATCH_SIZES = {
+  ('datastore_v3', 'Get'): lambda request, response: request.key_size(),
+  ('datastore_v3', 'Put'): lambda request, response: request.entity_size(),
+  ('datastore_v3', 'Delete'): lambda request, response: request.key_size(),
+  ('datastore_v3', 'RunQuery'): lambda request, response: response.result_size(),
+  ('datastore_v3', 'Next'): lambda request, response: response.result_size(),
+  ('memcache', 'Get'): lambda request, response: request.key_size(),
+  ('memcache', 'Set'): lambda request, response: request.item_size(),
+  ('memcache', 'Delete'): lambda request, response: request.item_size(),
+}
+
+Rpc = collections.namedtuple('Rpc', 'name batch_size latency_ms call_site')
+
+_local = threading.local()
+
+
+class RequestStats(object):
+  """The RPCs made while recording one request."""
+  def __init__(self):
+    self.rpcs = []
+    self.pending = {}
+    self.started = time.time()
+
+  def summary(self):
+    """Returns {rpc name: (count, items, ms)}, ordered by name."""
+    summary = collections.OrderedDict()
+    for rpc in sorted(self.rpcs, key=lambda rpc: rpc.name):
+      count, items, ms = summary.get(rpc.name, (0, 0, 0))
+      summary[rpc.name] = (count + 1, items + (rpc.batch_size or 0),
+                           ms + (rpc.latency_ms or 0))
+    return summary
+
+  def call_sites(self):
+    """Returns [(call site, count)] in decreasing order of count."""
+    return collections.Counter(rpc.call_site for rpc in self.rpcs).most_common()
+
+  @property
+  def total_ms(self):
+    return sum(rpc.latency_ms or 0 for rpc in self.rpcs)
+
+
+def _call_site():
+  frame = sys._getframe(2)
+  while frame is not None:
+    filename = os.path.abspath(frame.f_code.co_filename)
+    if (filename.startswith(APP_ROOT) and
+        os.path.splitext(filename)[0] != THIS_FILE):
+      return '%s:%d %s' % (os.path.relpath(filename, APP_ROOT), frame.f_lineno,
+                           frame.f_code.co_name)
+    frame = frame.f_back
+  return None
+
+
+def _pre_call(service, call, request, response, rpc=None):
+  stats = getattr(_local, 'stats', None)
+  if stats is not None:
+    stats.pending[id(rpc)] = (time.time(), _call_site())
+
+
+def _post_call(service, call, request, response, rpc=None, error=None):
+  stats = getattr(_local, 'stats', None)
+  if stats is None:
+    return
+  started, call_site = stats.pending.pop(id(rpc), (None, None))
+  batch_size = None
+  if error is None and (service, call) in BATCH_SIZES:
+    batch_size = BATCH_SIZES[service, call](request, response)
+  latency_ms = (time.time() - started) * 1000 if started else None
+  stats.rpcs.append(Rpc('%s.%s' % (service, call), batch_size, latency_ms, call_site))
+
+
+def install_hooks():
+  """Adds the hooks to the current apiproxy, unless they are there already."""
+  apiproxy = apiproxy_stub_map.apiproxy
+  apiproxy.GetPreCallHooks().Append('meta.rpcstats', _pre_call)
+  apiproxy.GetPostCallHooks().Append('meta.rpcstats', _post_call)
+
+
+def start():
+  install_hooks()
+  _local.stats = RequestStats()
+  return _local.stats
+
+
+def stop():
+  stats, _local.stats = getattr(_local, 'stats', None), None
+  return stats
@@ -0,0 +1,70 @@
+"""Word prefix search on the datastore, for the admin's search_fields.
+
+A model that lists `search_fields` in its Meta gets a repeated StringProperty,
+`search_tokens`, holding the prefixes of every word in those properties; it is
+refreshed each time the entity is put. Each search term then becomes an
+equality filter on it, which the datastore answers from its indexes however
+many entities the kind has.
+"""
+import re
+
+from google.appengine.ext import ndb
+
+SEARCH_PROPERTY = 'search_tokens'
+# Shorter prefixes would match most of the kind, and are not indexed.
+MIN_PREFIX_LENGTH = 2
+# Longer words are indexed, and searched for, by their first characters only.
+MAX_PREFIX_LENGTH = 20
+# Each token is a row in the property's indexes; words beyond this many
+# tokens, as in a long text, cannot be searched for.
+MAX_TOKENS = 1000
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def words(text):
+  return [word[:MAX_PREFIX_LENGTH] for word in WORD_RE.findall(text.lower())
+          if len(word) >= MIN_PREFIX_LENGTH]
+
+
+def tokens(values):
+  """Returns the prefixes of the words in `values`, for the search property."""
+  result = set()
+  for value in values:
+    for word in words(unicode(value)):
+      for length in range(MIN_PREFIX_LENGTH, len(word) + 1):
+        if len(result) >= MAX_TOKENS:
+          return sorted(result)
+        result.add(word[:length])
+  return sorted(result)
+
+
+def add_search_property(model):
+  """Adds the search property to a model whose Meta lists search_fields."""
+  if SEARCH_PROPERTY not in model._properties:
+    setattr(model, SEARCH_PROPERTY, ndb.StringProperty(repeated=True))
+    model._fix_up_properties()
+
+
+def update_tokens(entity):
+  values = []
+  for name in entity._meta.search_fields:
+    value = getattr(entity, name)
+    if isinstance(value, list):
+      values.extend(v for v in value if v is not None)
+    elif value is not None:
+      values.append(value)
+  setattr(entity, SEARCH_PROPERTY, tokens(values))
+
+
+def search_field_names(search_fields):
+  # Django's ^, = and @ lookups all come down to matching word prefixes here.
+  return [name.lstrip('^=@') for name in search_fields]
+
+
+def filter_query(query, model, search_term):
+  """Returns `query` filtered to the entities with words starting with each term."""
+  prop = model._properties[SEARCH_PROPERTY]
+  for word in sorted(set(words(search_term))):
+    query = query.filter(prop == word)
+  return query
@@ -0,0 +1,37 @@
+// Offers matching entities for KeySearchInput fields as the user types.
+(function() {
+  function attach(input) {
+    var list = document.createElement('datalist');
+    list.id = input.id + '_choices';
+    input.parentNode.insertBefore(list, input.nextSibling);
+    input.setAttribute('list', list.id);
+    var timer = null;
+    input.addEventListener('input', function() {
+      var terms = input.value.split(',');
+      var term = input.getAttribute('data-multiple') ? terms[terms.length - 1] : input.value;
+      clearTimeout(timer);
+      timer = setTimeout(function() {
+        var request = new XMLHttpRequest();
+        request.open('GET', input.getAttribute('data-choices-url') + '?q=' + encodeURIComponent(term.trim()));
+        request.onload = function() {
+          var results = JSON.parse(request.responseText).results;
+          list.innerHTML = '';
+          var prefix = terms.slice(0, -1).join(',');
+          for (var i = 0; i < results.length; i++) {
+            var option = document.createElement('option');
+            option.value = input.getAttribute('data-multiple') && prefix ? prefix + ',' + results[i].id : results[i].id;
+            option.textContent = results[i].text;
+            list.appendChild(option);
+          }
+        };
+        request.send();
+      }, 200);
+    });
+  }
+  document.addEventListener('DOMContentLoaded', function() {
+    var inputs = document.querySelectorAll('input.vKeySearchField');
+    for (var i = 0; i < inputs.length; i++) {
+      attach(inputs[i]);
+    }
+  });
+})();
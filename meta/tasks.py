@@ -0,0 +1,153 @@
+"""Datastore work too big for a single RPC, or for a single request."""
+import time
+
+import django
+from django.core.urlresolvers import reverse
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+from meta import export
+
+# The most keys the datastore accepts in one delete call.
+DELETE_BATCH_SIZE = 500
+# How many batches are sent before waiting for the oldest one to finish.
+MAX_BATCHES_IN_FLIGHT = 10
+# Larger deletions are done by a task rather than in the request.
+MAX_REQUEST_DELETES = 5000
+# Tasks hand over to a new task before the ten minute push task deadline.
+TASK_TIME_LIMIT = 8 * 60
+# The most bytes of an export stored in one ExportPart, well under the
+# datastore's 1MB entity limit.
+EXPORT_PART_SIZE = 900 * 1024
+
+
+def setup():
+  # Deferred tasks run outside of Django, possibly on a fresh instance, so the
+  # models they load may not have been imported yet.
+  django.setup()
+
+
+def delete_multi_batched(keys):
+  """Deletes `keys` in bounded batches, several of them in flight at once.
+
+  The kind's cache is invalidated, and its counter updated, once for them all.
+  """
+  from meta.models import bulk_writes
+  with bulk_writes() as bulk:
+    in_flight = []
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+      if len(in_flight) >= MAX_BATCHES_IN_FLIGHT:
+        for future in in_flight.pop(0):
+          future.get_result()
+      batch = keys[start:start + DELETE_BATCH_SIZE]
+      bulk.check_existing(batch)
+      in_flight.append(ndb.delete_multi_async(batch))
+    for batch in in_flight:
+      for future in batch:
+        future.get_result()
+
+
+def start_delete(keys_or_query, total):
+  """Deletes a list of keys, or everything matching a query, in a task.
+
+  Returns the Job that records its progress.
+  """
+  from meta.models import Job
+  if isinstance(keys_or_query, ndb.Query):
+    kind = keys_or_query.kind
+    # Orders do not matter for deletion, and the task only needs to pickle
+    # the filters.
+    keys_or_query = ndb.Query(kind=kind, ancestor=keys_or_query.ancestor,
+                              filters=keys_or_query.filters,
+                              namespace=keys_or_query.namespace)
+  else:
+    kind = keys_or_query[0].kind()
+  job = Job(description='Delete %d %s entities' % (total, kind), total=total)
+  job.put()
+  deferred.defer(_delete, job.key, keys_or_query)
+  return job
+
+
+def _delete(job_key, keys_or_query, cursor=None):
+  setup()
+  from meta.models import bulk_writes
+  deadline = time.time() + TASK_TIME_LIMIT
+  page_size = DELETE_BATCH_SIZE * MAX_BATCHES_IN_FLIGHT
+  more = True
+  with bulk_writes() as bulk:
+    while more and time.time() < deadline:
+      if isinstance(keys_or_query, ndb.Query):
+        keys, cursor, more = keys_or_query.fetch_page(
+            page_size, keys_only=True, start_cursor=cursor)
+      else:
+        keys, keys_or_query = keys_or_query[:page_size], keys_or_query[page_size:]
+        more = bool(keys_or_query)
+      delete_multi_batched(keys)
+      job = job_key.get()
+      job.done += len(keys)
+      job.finished = not more
+      job.put()
+      # Along with the job's progress, so the counter keeps up with it.
+      bulk.flush()
+  if more:
+    deferred.defer(_delete, job_key, keys_or_query, cursor)
+
+
+def start_export(query, fmt):
+  """Exports everything matching a query, in its order, in a task.
+
+  The output is stored in ExportParts under the Job that records progress;
+  when it is done, the Job's download_url serves it. The Job's total is
+  unknown until the task has counted the entities.
+  """
+  from meta.models import Job
+  job = Job(description='Export %s entities as %s' % (query.kind, fmt), total=None)
+  job.put()
+  # The changelist's query carries an unpicklable _clone.
+  query = ndb.Query(kind=query.kind, ancestor=query.ancestor,
+                    filters=query.filters, orders=query.orders,
+                    namespace=query.namespace)
+  deferred.defer(_export, job.key, query, fmt)
+  return job
+
+
+def _export(job_key, query, fmt, cursor=None, part=0):
+  setup()
+  from meta.models import ExportPart
+  deadline = time.time() + TASK_TIME_LIMIT
+  fields = export.export_fields(ndb.Model._kind_map[query.kind]._meta)
+  chunk = [] if part else [export.header(fmt, fields)]
+  size = sum(map(len, chunk))
+  # The first task counts the entities alongside its pages, rather than the
+  # request which started the export.
+  total = query.count_async() if cursor is None else None
+  more = True
+  while more and time.time() < deadline:
+    entities, cursor, more = query.fetch_page(
+        export.EXPORT_BATCH_SIZE, start_cursor=cursor)
+    more = more and cursor is not None
+    parts = []
+    for entity in entities:
+      line = export.line(fmt, fields, entity)
+      chunk.append(line)
+      size += len(line)
+      if size >= EXPORT_PART_SIZE:
+        part += 1
+        parts.append(ExportPart(id=part, parent=job_key, data=''.join(chunk)))
+        chunk, size = [], 0
+    if chunk and (not more or time.time() >= deadline):
+      # The next task starts from the cursor, so this one writes all it has.
+      part += 1
+      parts.append(ExportPart(id=part, parent=job_key, data=''.join(chunk)))
+      chunk, size = [], 0
+    job = job_key.get()
+    job.done += len(entities)
+    if total is not None:
+      job.total, total = total.get_result(), None
+    job.finished = not more
+    if job.finished:
+      job.download_url = reverse('admin:export_download', args=(
+          job_key.urlsafe(), '%s.%s' % (query.kind, fmt)))
+    ndb.put_multi(parts + [job])
+  if more:
+    deferred.defer(_export, job_key, query, fmt, cursor, part)
@@ -0,0 +1,82 @@
+import datetime
+
+from django import template
+from django.utils import formats
+from django.utils.text import capfirst
+from django.utils.translation import ugettext as _
+
+from meta import export
+from meta.admin import CURSOR_VAR, DIRECTION_VAR, EXPORT_VAR
+
+register = template.Library()
+
+@register.inclusion_tag('admin/ndb_pagination.html')
+def ndb_pagination(cl):
+  """Previous/next links for a changelist paged with datastore cursors."""
+  previous_url = next_url = None
+  if cl.previous_cursor:
+    previous_url = cl.get_query_string({
+        CURSOR_VAR: cl.previous_cursor.urlsafe(), DIRECTION_VAR: 'prev'})
+  if cl.next_cursor:
+    next_url = cl.get_query_string({CURSOR_VAR: cl.next_cursor.urlsafe()})
+  return {
+      'cl': cl,
+      'previous_url': previous_url,
+      'next_url': next_url,
+  }
+
+
+@register.inclusion_tag('admin/date_hierarchy.html')
+def ndb_date_hierarchy(cl):
+  """The date hierarchy links, from the dates NdbChangeList found."""
+  if not cl.date_hierarchy:
+    return {}
+  field_name = cl.date_hierarchy
+  year_field = '%s__year' % field_name
+  month_field = '%s__month' % field_name
+  day_field = '%s__day' % field_name
+  link = lambda filters: cl.get_query_string(filters, ['%s__' % field_name])
+  year, month, day, dates = cl.date_hierarchy_future.get_result()
+
+  if year and month and day:
+    date = datetime.date(year, month, day)
+    return {
+        'show': True,
+        'back': {
+            'link': link({year_field: year, month_field: month}),
+            'title': capfirst(formats.date_format(date, 'YEAR_MONTH_FORMAT')),
+        },
+        'choices': [{'title': capfirst(formats.date_format(date, 'MONTH_DAY_FORMAT'))}],
+    }
+  elif year and month:
+    return {
+        'show': True,
+        'back': {'link': link({year_field: year}), 'title': str(year)},
+        'choices': [{
+            'link': link({year_field: year, month_field: month, day_field: date.day}),
+            'title': capfirst(formats.date_format(date, 'MONTH_DAY_FORMAT')),
+        } for date in dates],
+    }
+  elif year:
+    return {
+        'show': True,
+        'back': {'link': link({}), 'title': _('All dates')},
+        'choices': [{
+            'link': link({year_field: year, month_field: date.month}),
+            'title': capfirst(formats.date_format(date, 'YEAR_MONTH_FORMAT')),
+        } for date in dates],
+    }
+  return {
+      'show': True,
+      'choices': [{
+          'link': link({year_field: str(date.year)}),
+          'title': str(date.year),
+      } for date in dates],
+  }
+
+
+@register.inclusion_tag('admin/ndb_export_links.html')
+def ndb_export_links(cl):
+  """Links exporting everything the changelist matches, in each format."""
+  return {'links': [(cl.get_query_string({EXPORT_VAR: fmt}), fmt.upper())
+                    for fmt in export.FORMATS]}
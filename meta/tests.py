@@ -1,3 +1,164 @@
-from django.test import TestCase
+import datetime
+import os
+import shutil
+import tempfile
 
-# Create your tests here.
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from meta import batch
+from meta import counters
+from meta import middleware
+from meta import models
+from meta import rpcstats
+from meta import search
+from meta import tasks
+from meta.admin import next_period
+from meta.models import DjangoCompatibleModel
+
+
+class NdbTestCase(SimpleTestCase):
+  """Runs each test against fresh datastore and memcache stubs."""
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    # Queries see every write, as the tests don't wait for indexes to apply.
+    self.testbed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+
+  def tearDown(self):
+    # As ndb.toplevel would at the end of a request, so that RPCs left in
+    # flight don't complete during, and get counted by, the next test.
+    ndb.eventloop.run()
+    self.testbed.deactivate()
+
+
+class SearchTest(SimpleTestCase):
+  def test_tokens(self):
+    self.assertEqual(search.tokens([u'Dune', u'a Dune', 1965]),
+                     ['19', '196', '1965', 'du', 'dun', 'dune'])
+    word = u'x' * (search.MAX_PREFIX_LENGTH + 5)
+    self.assertEqual(max(map(len, search.tokens([word]))), search.MAX_PREFIX_LENGTH)
+    self.assertEqual(len(search.tokens([u' '.join(u'w%04d' % i for i in range(1000))])),
+                     search.MAX_TOKENS)
+
+
+class NextPeriodTest(SimpleTestCase):
+  def test_next_period(self):
+    self.assertEqual(next_period(datetime.date(2016, 5, 1), 'year'), datetime.date(2017, 1, 1))
+    self.assertEqual(next_period(datetime.date(2016, 11, 1), 'month'), datetime.date(2016, 12, 1))
+    self.assertEqual(next_period(datetime.date(2016, 12, 1), 'month'), datetime.date(2017, 1, 1))
+    self.assertEqual(next_period(datetime.date(2016, 2, 28), 'day'), datetime.date(2016, 2, 29))
+    self.assertEqual(next_period(datetime.date(2016, 12, 31), 'day'), datetime.date(2017, 1, 1))
+
+
+class CountedModel(DjangoCompatibleModel):
+  name = ndb.StringProperty()
+
+  class Meta:
+    sharded_count = True
+
+
+class ShardedCountTest(NdbTestCase):
+  def count(self):
+    return counters.get_sharded_count_async(CountedModel._get_kind()).get_result()
+
+  def test_inserts(self):
+    CountedModel().put()
+    CountedModel(id='named').put()
+    start, end = CountedModel.allocate_ids(1)
+    CountedModel(id=start).put()
+    CountedModel.get_or_insert('named')
+    CountedModel.get_or_insert('other')
+    self.assertEqual(self.count(), 4)
+
+  def test_updates_and_deletes(self):
+    entity = CountedModel(id='named')
+    entity.put()
+    entity.put()
+    self.assertEqual(self.count(), 1)
+    entity.key.delete()
+    entity.key.delete()
+    CountedModel(id='missing').key.delete()
+    self.assertEqual(self.count(), 0)
+
+  def test_rollback(self):
+    @ndb.transactional
+    def put_and_fail():
+      CountedModel(id='named').put()
+      raise ndb.Rollback()
+    put_and_fail()
+    self.assertEqual(self.count(), 0)
+
+    ndb.transaction(lambda: CountedModel(id='named').put())
+    self.assertEqual(self.count(), 1)
+
+  def test_bulk_writes(self):
+    CountedModel(id='existing').put()
+    with models.bulk_writes() as bulk:
+      keys = [ndb.Key(CountedModel, name) for name in ('existing', 'new', 'missing')]
+      stats = rpcstats.start()
+      bulk.check_existing(keys)
+      ndb.put_multi([CountedModel(key=key) for key in keys[:2]])
+      ndb.delete_multi(keys[::2])
+      rpcstats.stop()
+    self.assertEqual(self.count(), 1)
+    # The writes' hooks needed no get of their own.
+    self.assertEqual(stats.summary()['datastore_v3.Get'][0], 1)
+
+  def test_write_batch(self):
+    parent = CountedModel(id='parent')
+    parent.put()
+    start, end = CountedModel.allocate_ids(1)
+    write_batch = batch.WriteBatch()
+    # As the admin saves a new entity, with an allocated id.
+    write_batch.put(CountedModel(id=start))
+    # In the parent's group, so written in a transaction.
+    write_batch.put_multi([parent, CountedModel(id='child', parent=parent.key)])
+    write_batch.delete(ndb.Key(CountedModel, 'missing'))
+    stats = rpcstats.start()
+    write_batch.flush()
+    rpcstats.stop()
+    self.assertEqual(self.count(), 3)
+    self.assertEqual(stats.summary()['memcache.BatchIncrement'][0], 1)
+
+  def test_delete_multi_batched(self):
+    keys = ndb.put_multi([CountedModel() for i in range(3)])
+    tasks.delete_multi_batched(keys[1:] + [ndb.Key(CountedModel, 'missing')])
+    self.assertEqual(self.count(), 1)
+
+
+class StaffUser(object):
+  is_staff = True
+
+
+class RpcStatsMiddlewareTest(SimpleTestCase):
+  def process(self, user):
+    request = RequestFactory().get('/', {'profile': ''})
+    if user is not None:
+      request.user = user
+    rpc_middleware = middleware.RpcStatsMiddleware()
+    rpc_middleware.process_request(request)
+    rpc_middleware.process_view(request, None, (), {})
+    profiling = request.profiler is not None
+    return profiling, rpc_middleware.process_response(request, HttpResponse())
+
+  @override_settings(META_PROFILE_DIR='/nonexistent')
+  def test_anonymous(self):
+    profiling, response = self.process(None)
+    self.assertFalse(profiling)
+    self.assertFalse(response.has_header('X-Rpc-Count'))
+
+  def test_staff(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    with self.settings(META_PROFILE_DIR=directory):
+      profiling, response = self.process(StaffUser())
+    self.assertTrue(profiling)
+    self.assertEqual(len(os.listdir(directory)), 1)
+    self.assertEqual(response['X-Rpc-Count'], '0')
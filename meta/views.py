@@ -0,0 +1,58 @@
+import os
+
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
+
+from meta import export
+from meta.models import ExportPart, Job
+
+CHOICES_PAGE_SIZE = 20
+
+
+def key_choices(request, kind):
+  """Returns a page of entities of `kind` whose label starts with `q`, as JSON.
+
+  Backs KeySearchInput. The search is a prefix range on the first of the
+  model's `label_fields`, so it is served by the built-in single property index;
+  `cursor` continues from the previous page.
+  """
+  model = ndb.Model._kind_map.get(kind)
+  if model is None or not hasattr(model, '_meta'):
+    raise Http404
+  label_fields = model._meta.label_fields
+  query = model.query()
+  term = request.GET.get('q', '')
+  if term and label_fields:
+    prop = model._properties[label_fields[0]]
+    query = query.filter(prop >= term, prop < term + u'\ufffd').order(prop)
+  try:
+    cursor = request.GET.get('cursor')
+    cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+  except datastore_errors.BadValueError:
+    raise Http404
+  results, next_cursor, more = query.fetch_page(
+      CHOICES_PAGE_SIZE, start_cursor=cursor, projection=label_fields or None)
+  return JsonResponse({
+      'results': [{'id': x.key.urlsafe(), 'text': unicode(x)} for x in results],
+      'cursor': next_cursor.urlsafe() if more and next_cursor else None,
+  })
+
+
+def export_download(request, job_id, filename):
+  """Streams the output of a finished export task, a part at a time."""
+  try:
+    job_key = ndb.Key(urlsafe=job_id)
+  except (datastore_errors.Error, ProtocolBufferDecodeError, TypeError):
+    raise Http404
+  fmt = os.path.splitext(filename)[1].lstrip('.')
+  job = job_key.get() if job_key.kind() == Job._get_kind() else None
+  if job is None or not job.finished or fmt not in export.FORMATS:
+    raise Http404
+  parts = ExportPart.query(ancestor=job_key).order(ExportPart.key)
+  response = StreamingHttpResponse(
+      (part.data for part in parts.iter(batch_size=10)),
+      content_type=export.FORMATS[fmt])
+  response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+  return response